@@ -1,5 +1,6 @@
 import os
 from agents.mcq_agent import generate_questions as base_generate
+from agents.registry import SubjectSpec, register_subject
 
 AA_INSTRUCTION = """
 You are an expert in Analytics/Statistical programming.
@@ -54,6 +55,12 @@ Do NOT include questions about Java or other languages.
 Use small code snippets when useful.
 """
 
+register_subject(SubjectSpec(
+    id="analytics",
+    name="Analytics",
+    instruction=AA_INSTRUCTION,
+))
+
 async def generate_analytics_questions(
     difficulty: str,
     num_questions: int,
@@ -1,5 +1,6 @@
 import os
 from agents.mcq_agent import generate_questions as base_generate
+from agents.registry import SubjectSpec, register_subject
 
 CASANDRA_INSTRUCTION = """
 You are an expert in Apache Cassandra and CQL (Cassandra Query Language).
@@ -47,6 +48,12 @@ Do NOT include questions about SQL databases (MySQL, PostgreSQL), Python, Java,
 Use small CQL code snippets when useful.
 """
 
+register_subject(SubjectSpec(
+    id="cassandra",
+    name="Cassandra",
+    instruction=CASANDRA_INSTRUCTION,
+))
+
 async def generate_cassandra_questions(
     difficulty: str,
     num_questions: int,
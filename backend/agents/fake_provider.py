@@ -0,0 +1,201 @@
+import os
+import re
+import json
+import time
+import random
+import asyncio
+import functools
+from typing import AsyncIterator, Callable
+from agents.mcq_agent import CHARS_PER_TOKEN, register_gemini_model, register_provider
+from agents.schema import STRUCTURED_OUTPUT
+from agents.metrics import FIRST_TOKEN_SECONDS, PROVIDER_SECONDS
+
+# Offline stand-in for both provider slots, enabled with MCQ_PROVIDER=fake.
+# The Gemini slot keeps its ADK Runner with a FakeLlm model under it; the
+# fallback slot is replaced by FakeProvider.stream.
+# Latency is "fixed:S", "uniform:LO:HI", "lognormal:MEDIAN:SIGMA" or
+# "pareto:MIN:ALPHA", in seconds to the first token.
+FAKE_LLM_LATENCY = os.getenv("FAKE_LLM_LATENCY", "lognormal:1.5:0.5")
+FAKE_LLM_TOKENS_PER_SECOND = float(os.getenv("FAKE_LLM_TOKENS_PER_SECOND", "250"))
+FAKE_LLM_ERROR_RATE = float(os.getenv("FAKE_LLM_ERROR_RATE", "0"))
+FAKE_LLM_QUOTA_RATE = float(os.getenv("FAKE_LLM_QUOTA_RATE", "0"))
+FAKE_LLM_TRUNCATE_RATE = float(os.getenv("FAKE_LLM_TRUNCATE_RATE", "0"))
+FAKE_LLM_SEED = int(os.getenv("FAKE_LLM_SEED", "0"))
+# Streamed in chunks of about this many tokens, like Gemini's SSE events
+CHUNK_TOKENS = 24
+
+_PROMPT = re.compile(r"Generate (\d+) (\w+) difficulty MCQ questions on ([^,.\n]+)")
+_STEMS = (
+    "What is the output of the following code",
+    "Which of the following is true about",
+    "Which statement best describes",
+    "What happens when",
+    "Which command is used for",
+)
+
+def parse_latency(spec: str) -> Callable[[random.Random], float]:
+    """Sampler for a latency spec like "lognormal:1.5:0.5"."""
+    kind, *args = spec.split(":")
+    values = [float(arg) for arg in args]
+    if kind == "fixed":
+        return lambda rng: values[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "lognormal":
+        # Parameterised by the median rather than mu, which is easier to read off a dashboard
+        median, sigma = values
+        return lambda rng: median * rng.lognormvariate(0, sigma)
+    if kind == "pareto":
+        minimum, alpha = values
+        return lambda rng: minimum * rng.paretovariate(alpha)
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+class FakeProviderError(Exception):
+    def __init__(self, message: str, code: int):
+        super().__init__(message)
+        self.code = code
+
+class FakeProvider:
+    """
+    Provider slot implementation that needs no network or API key. Replies
+    are well-formed question JSON (bare with structured output, fenced free
+    text otherwise) after a sampled first-token latency, streamed at
+    tokens_per_second. A share of calls fail with a 429 or a 503, or stop
+    partway through the JSON. Seeded, so runs with the same settings draw the
+    same latencies, failures and questions.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        latency: str = FAKE_LLM_LATENCY,
+        tokens_per_second: float = FAKE_LLM_TOKENS_PER_SECOND,
+        error_rate: float = FAKE_LLM_ERROR_RATE,
+        quota_rate: float = FAKE_LLM_QUOTA_RATE,
+        truncate_rate: float = FAKE_LLM_TRUNCATE_RATE,
+        seed: int = FAKE_LLM_SEED,
+    ):
+        self.name = name
+        self.latency = parse_latency(latency)
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.quota_rate = quota_rate
+        self.truncate_rate = truncate_rate
+        self.rng = random.Random(f"{name}:{seed}")
+        self.words = ["".join(self.rng.choices("etaoinshrdlucmfwypvbgk", k=self.rng.randint(3, 9))) for _ in range(4000)]
+
+    def questions(self, num_questions: int, subject: str, code: bool = False) -> list[dict]:
+        """Well-formed random questions; with code, each one carries a Java snippet. Also the data for the benches."""
+        rng = self.rng
+        return [
+            {
+                "id": i,
+                "question": self._snippet() if code else (
+                    f"{rng.choice(_STEMS)} {subject} " + " ".join(rng.choices(self.words, k=12)) + "?"
+                ),
+                "options": {letter: " ".join(rng.choices(self.words, k=4)) for letter in "ABCD"},
+                "correct_answer": rng.choice("ABCD"),
+                "explanation": " ".join(rng.choices(self.words, k=20)) + ".",
+            }
+            for i in range(1, num_questions + 1)
+        ]
+
+    def _snippet(self) -> str:
+        rng = self.rng
+        lines = "\n".join(
+            f"    int {rng.choice(self.words)} = {rng.randint(0, 99)}; // {' '.join(rng.choices(self.words, k=4))}"
+            for _ in range(rng.randint(3, 8))
+        )
+        return f"What is the output of the following code?\n```java\npublic class Main {{\n{lines}\n}}\n```"
+
+    def reply(self, num_questions: int, subject: str) -> str:
+        questions = self.questions(num_questions, subject)
+        if STRUCTURED_OUTPUT:
+            # What schema-constrained output looks like: bare JSON, nothing around it
+            return json.dumps({"questions": questions})
+        return "```json\n" + json.dumps({"questions": questions}, indent=2) + "\n```"
+
+    async def chunks(self, prompt: str) -> AsyncIterator[str]:
+        """Reply to prompt in CHUNK_TOKENS pieces after the first-token latency, or fail the way the draw says."""
+        match = _PROMPT.search(prompt)
+        num_questions, subject = (int(match.group(1)), match.group(3)) if match else (5, "computer science")
+        # Draw everything up front so concurrent calls do not interleave the generator
+        rng = self.rng
+        first_token = self.latency(rng)
+        roll = rng.random()
+        text = self.reply(num_questions, subject)
+        if rng.random() < self.truncate_rate:
+            text = text[:rng.randrange(len(text) // 4, len(text) - 1)]
+
+        await asyncio.sleep(first_token)
+        if roll < self.quota_rate:
+            raise FakeProviderError("429 RESOURCE_EXHAUSTED: fake quota exceeded, retryDelay: 20s", 429)
+        if roll < self.quota_rate + self.error_rate:
+            raise FakeProviderError("503 UNAVAILABLE: fake provider error", 503)
+        step = CHUNK_TOKENS * CHARS_PER_TOKEN
+        for i in range(0, len(text), step):
+            if i:
+                await asyncio.sleep(CHUNK_TOKENS / self.tokens_per_second)
+            yield text[i:i + step]
+
+    async def stream(
+        self,
+        prompt: str,
+        api_key: str,
+        extra_instruction: str | None = None,
+        model: str | None = None,
+    ) -> AsyncIterator[str]:
+        """chunks() with the provider slot signature and metrics."""
+        started = time.perf_counter()
+        streamed = False
+        outcome = "error"
+        try:
+            async for text in self.chunks(prompt):
+                if not streamed:
+                    FIRST_TOKEN_SECONDS.labels(self.name).observe(time.perf_counter() - started)
+                streamed = True
+                yield text
+            outcome = "ok"
+        except (asyncio.CancelledError, GeneratorExit):
+            outcome = "cancelled"
+            raise
+        finally:
+            PROVIDER_SECONDS.labels(self.name, outcome).observe(time.perf_counter() - started)
+
+@functools.cache
+def _fake_llm_class() -> type:
+    # ADK is imported lazily, like the real model classes in agents.mcq_agent
+    from google.adk.models import BaseLlm
+    from google.adk.models.llm_response import LlmResponse
+    from google.genai import types
+
+    class FakeLlm(BaseLlm):
+        """ADK model that answers from a FakeProvider, so fake runs still exercise the Runner."""
+        provider: FakeProvider
+
+        async def generate_content_async(self, llm_request, stream: bool = False):
+            prompt = "".join(part.text or "" for part in llm_request.contents[-1].parts)
+            parts = []
+            async for text in self.provider.chunks(prompt):
+                parts.append(text)
+                if stream:
+                    yield LlmResponse(content=types.Content(role="model", parts=[types.Part(text=text)]), partial=True)
+            # Like Gemini's SSE mode, the final response repeats the whole text and carries the usage
+            text = "".join(parts)
+            instruction = llm_request.config.system_instruction if llm_request.config else None
+            yield LlmResponse(
+                content=types.Content(role="model", parts=[types.Part(text=text)]),
+                usage_metadata=types.GenerateContentResponseUsageMetadata(
+                    prompt_token_count=(len(prompt) + len(str(instruction or ""))) // CHARS_PER_TOKEN,
+                    candidates_token_count=len(text) // CHARS_PER_TOKEN,
+                ),
+            )
+
+    return FakeLlm
+
+def install_fake_providers(**settings) -> dict[str, FakeProvider]:
+    """Serve both provider slots from FakeProviders; settings override the FAKE_LLM_* defaults."""
+    fakes = {slot: FakeProvider(f"fake_{slot}", **settings) for slot in ("gemini", "fallback")}
+    register_gemini_model(lambda model, api_key: _fake_llm_class()(model=model, provider=fakes["gemini"]))
+    register_provider("fallback", fakes["fallback"].stream)
+    return fakes
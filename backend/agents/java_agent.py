@@ -1,5 +1,6 @@
 import os
 from agents.mcq_agent import generate_questions as base_generate
+from agents.registry import SubjectSpec, register_subject
 
 JAVA_INSTRUCTION = """
 You are an expert in Java programming.
@@ -29,6 +30,12 @@ Do NOT include questions about any other language.
 Use code snippets in questions where it helps.
 """
 
+register_subject(SubjectSpec(
+    id="java",
+    name="Java",
+    instruction=JAVA_INSTRUCTION,
+))
+
 async def generate_java_questions(
     difficulty: str,
     num_questions: int,
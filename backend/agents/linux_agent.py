@@ -1,5 +1,6 @@
 import os
 from agents.mcq_agent import generate_questions as base_generate
+from agents.registry import SubjectSpec, register_subject
 
 LINUX_INSTRUCTION = """
 You are an expert in Linux and shell programming.
@@ -28,6 +29,12 @@ Generate questions ONLY about Linux:
 Do NOT include questions about Python, Java, or other programming languages. Use small shell command snippets when useful.
 """
 
+register_subject(SubjectSpec(
+    id="linux",
+    name="linux",
+    instruction=LINUX_INSTRUCTION,
+))
+
 async def generate_linux_questions(
     difficulty: str,
     num_questions: int,
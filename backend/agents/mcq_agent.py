@@ -1,23 +1,159 @@
 import os
+import re
+import sys
+import json
+import math
+import time
+import random
 import asyncio
+import contextvars
+import functools
+import threading
+from types import SimpleNamespace
+from collections import OrderedDict, defaultdict, deque
+from typing import TYPE_CHECKING, AsyncIterator, Awaitable, Callable
 from dotenv import load_dotenv
-from google.genai import types
-from google.adk.agents import Agent as LlmAgent
-from google.adk.models import Gemini
-from google.adk.runners import Runner
-from google.adk.sessions import InMemorySessionService
-from litellm import acompletion
+from agents.parsing import parse_llm_response, QuestionStreamParser
+from agents.schema import QUESTION_SET_SCHEMA, STRUCTURED_OUTPUT
+from agents.shared_state import SharedState, key_id, shared_state
+from agents.metrics import (
+    FALLBACKS, FIRST_TOKEN_SECONDS, OUTPUT_BUDGET_USE, OUTPUT_TOKENS_SAVED, PROVIDER_SECONDS, RETRIES, TOKENS,
+    TOKENS_SAVED, span,
+)
+
+if TYPE_CHECKING:
+    from google.genai import Client
+    from google.adk.agents import Agent as LlmAgent
+    from google.adk.models import BaseLlm
+    from google.adk.runners import Runner
 
 if os.getenv('RENDER') is None:
     load_dotenv()
 
-# Retry config
-retry_config = types.HttpRetryOptions(
-    attempts=3,
-    exp_base=7,
-    initial_delay=1,
-    http_status_codes=[429, 500, 502, 503, 504],
-)
+GEMINI_MODEL = "gemini-2.5-flash"
+APP_NAME = "agents"
+USER_ID = "user1"
+
+# One genai Client (and its HTTP connection pool) per API key
+CLIENT_POOL_SIZE = int(os.getenv("GEMINI_CLIENT_POOL_SIZE", "32"))
+_client_pool: "OrderedDict[str, Client]" = OrderedDict()
+
+# Prebuilt runners, keyed by (subject instruction, model, API key), reused across requests
+RUNNER_POOL_SIZE = int(os.getenv("RUNNER_POOL_SIZE", "64"))
+_runner_pool: "OrderedDict[tuple[str, str, str], Runner]" = OrderedDict()
+# Builds the Gemini slot's model from (model, api_key); None uses KeyedGemini.
+# agents.fake_provider sets it so offline runs still go through the Runner
+_gemini_model: "Callable[[str, str], BaseLlm] | None" = None
+
+# Requests larger than this are split into concurrent shards
+SHARD_SIZE = int(os.getenv("MCQ_SHARD_SIZE", "10"))
+SHARD_ATTEMPTS = int(os.getenv("MCQ_SHARD_ATTEMPTS", "2"))
+
+# Hedging: if the preferred provider has no first token by its rolling p95,
+# the other provider is started in parallel and the first answer wins
+HEDGE_ENABLED = os.getenv("MCQ_HEDGING", "1") == "1"
+HEDGE_DEFAULT_DELAY = float(os.getenv("MCQ_HEDGE_DEFAULT_DELAY", "8"))
+HEDGE_MIN_DELAY = float(os.getenv("MCQ_HEDGE_MIN_DELAY", "1"))
+HEDGE_MAX_DELAY = float(os.getenv("MCQ_HEDGE_MAX_DELAY", "20"))
+HEDGE_MIN_SAMPLES = 20
+# The fallback is tried first only once its measured score is below this
+# share of Gemini's; it only gets samples from hedged and failed-over calls
+HEDGE_SWITCH_RATIO = float(os.getenv("MCQ_HEDGE_SWITCH_RATIO", "0.5"))
+STATS_WINDOW = 200
+
+# Circuit breakers per (provider, API key): quota errors open the circuit for
+# the quota reset window, repeated other failures for a short cooldown
+CIRCUIT_QUOTA_WINDOW = float(os.getenv("MCQ_CIRCUIT_QUOTA_WINDOW", "60"))
+CIRCUIT_DAILY_QUOTA_WINDOW = float(os.getenv("MCQ_CIRCUIT_DAILY_QUOTA_WINDOW", "3600"))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("MCQ_CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_COOLDOWN = float(os.getenv("MCQ_CIRCUIT_COOLDOWN", "30"))
+CIRCUIT_POOL_SIZE = 1024
+# A half-open probe not resolved by then (its worker died) lets another one through
+CIRCUIT_PROBE_TIMEOUT = float(os.getenv("MCQ_CIRCUIT_PROBE_TIMEOUT", "120"))
+
+# Prompt compaction: the system instruction is BASE_INSTRUCTION alone, shared
+# by every subject's runner; the subject's header and rules plus a subset of
+# its topics sized to the request go in the user prompt
+PROMPT_COMPACTION = os.getenv("MCQ_PROMPT_COMPACTION", "1") == "1"
+TOPICS_PER_QUESTION = float(os.getenv("MCQ_TOPICS_PER_QUESTION", "0.5"))
+MIN_TOPICS = 2
+# Rough characters per token for English and code with the Gemini and GPT tokenizers
+CHARS_PER_TOKEN = 4
+# Reply tokens per question by difficulty (hard ones carry more code), plus
+# headroom so replies are not truncated; None leaves the provider default
+OUTPUT_TOKENS_PER_QUESTION = {"easy": 150, "medium": 190, "hard": 260}
+OUTPUT_TOKEN_OVERHEAD = 40
+OUTPUT_TOKEN_MARGIN = float(os.getenv("MCQ_OUTPUT_TOKEN_MARGIN", "1.3"))
+OUTPUT_BUDGET_ENABLED = os.getenv("MCQ_OUTPUT_BUDGET", "1") == "1"
+# Log prompt size, savings and output budget per request, and budget use per reply
+LOG_PROMPTS = os.getenv("MCQ_LOG_PROMPTS", "0") == "1"
+# Gemini 2.5 counts thinking towards max_output_tokens, so thinking gets a
+# fixed budget that is added on top; -1 leaves thinking to the model and
+# Gemini replies uncapped
+GEMINI_THINKING_BUDGET = int(os.getenv("GEMINI_THINKING_BUDGET", "1024"))
+# Output budget of the generation running in this context (shard, hedge or stream)
+_output_budget: contextvars.ContextVar[int | None] = contextvars.ContextVar("mcq_output_budget", default=None)
+
+# The provider SDKs (google.adk, google.genai, litellm) take seconds to import,
+# so they are loaded on first use, or warmed in the background at startup
+_sdk_lock = threading.Lock()
+
+@functools.cache
+def _load_sdk() -> SimpleNamespace:
+    started = time.perf_counter()
+    from google.genai import Client, types
+    from google.adk.agents import Agent as LlmAgent
+    from google.adk.models import Gemini
+    from google.adk.agents.run_config import RunConfig, StreamingMode
+    from google.adk.planners import BuiltInPlanner
+    from google.adk.runners import Runner
+    from google.adk.sessions import InMemorySessionService
+    from litellm import acompletion, supports_response_schema
+
+    class KeyedGemini(Gemini):
+        """Gemini model bound to an explicit API key instead of GEMINI_API_KEY in os.environ."""
+        api_key: str
+
+        @property
+        def api_client(self) -> Client:
+            return get_client(self.api_key)
+
+    retry_config = types.HttpRetryOptions(
+        attempts=3,
+        exp_base=7,
+        initial_delay=1,
+        http_status_codes=[429, 500, 502, 503, 504],
+    )
+    print(f"Provider SDKs loaded in {time.perf_counter() - started:.1f}s")
+    return SimpleNamespace(
+        Client=Client,
+        types=types,
+        LlmAgent=LlmAgent,
+        KeyedGemini=KeyedGemini,
+        RunConfig=RunConfig,
+        StreamingMode=StreamingMode,
+        Runner=Runner,
+        BuiltInPlanner=BuiltInPlanner,
+        InMemorySessionService=InMemorySessionService,
+        acompletion=acompletion,
+        supports_response_schema=supports_response_schema,
+        retry_config=retry_config,
+    )
+
+def sdk() -> SimpleNamespace:
+    """The provider SDKs, imported on first call."""
+    # functools.cache does not stop two threads importing at once; the lock does
+    with _sdk_lock:
+        return _load_sdk()
+
+def sdk_loaded() -> bool:
+    return _load_sdk.cache_info().currsize > 0
+
+async def warm_sdk() -> SimpleNamespace:
+    """Like sdk(), but a first-time import runs in a worker thread so the event loop keeps serving requests."""
+    if sdk_loaded():
+        return sdk()
+    return await asyncio.to_thread(sdk)
 
 # Base instruction
 BASE_INSTRUCTION = """
@@ -48,38 +184,723 @@ Output format (strict JSON):
 }
 """
 
-def build_agent(extra_instruction: str | None = None) -> LlmAgent:
-    """Create a Gemini-based MCQ agent. Optionally extended with subject-specific instructions."""
-    instruction = BASE_INSTRUCTION
+def system_instruction(extra_instruction: str | None = None) -> str:
     if extra_instruction:
-        instruction = BASE_INSTRUCTION + "\n\n" + extra_instruction
-    return LlmAgent(
-        model=Gemini(
-            model="gemini-2.5-flash",
-            retry_options=retry_config,
-        ),
+        return BASE_INSTRUCTION + "\n\n" + extra_instruction
+    return BASE_INSTRUCTION
+
+def get_client(api_key: str) -> "Client":
+    """Return the pooled genai Client for this API key, creating it on first use."""
+    client = _client_pool.get(api_key)
+    if client is not None:
+        _client_pool.move_to_end(api_key)
+        return client
+
+    lib = sdk()
+    client = lib.Client(
+        api_key=api_key,
+        http_options=lib.types.HttpOptions(retry_options=lib.retry_config),
+    )
+    _client_pool[api_key] = client
+    while len(_client_pool) > CLIENT_POOL_SIZE:
+        _client_pool.popitem(last=False)
+    return client
+
+def build_agent(
+    api_key: str,
+    extra_instruction: str | None = None,
+    model: str = GEMINI_MODEL,
+) -> "LlmAgent":
+    """Create a Gemini-based MCQ agent. Optionally extended with subject-specific instructions."""
+    lib = sdk()
+    planner = None
+    if OUTPUT_BUDGET_ENABLED and GEMINI_THINKING_BUDGET >= 0:
+        planner = lib.BuiltInPlanner(
+            thinking_config=lib.types.ThinkingConfig(thinking_budget=GEMINI_THINKING_BUDGET)
+        )
+    config = None
+    if STRUCTURED_OUTPUT:
+        config = lib.types.GenerateContentConfig(
+            response_mime_type="application/json",
+            response_json_schema=QUESTION_SET_SCHEMA,
+        )
+    if _gemini_model is not None:
+        llm = _gemini_model(model, api_key)
+    else:
+        llm = lib.KeyedGemini(
+            model=model,
+            api_key=api_key,
+            retry_options=lib.retry_config,
+        )
+    return lib.LlmAgent(
+        model=llm,
         name="mcq_agent",
-        instruction=instruction,
+        instruction=system_instruction(extra_instruction),
+        planner=planner,
+        generate_content_config=config,
+        before_model_callback=_apply_output_budget,
     )
 
-async def fallback_generate(
+def _apply_output_budget(callback_context, llm_request):
+    """before_model_callback: cap the reply at the output budget of the generation being run."""
+    budget = _output_budget.get()
+    if budget and GEMINI_THINKING_BUDGET >= 0 and llm_request.config is not None:
+        llm_request.config.max_output_tokens = budget + GEMINI_THINKING_BUDGET
+    return None
+
+def get_runner(
+    api_key: str,
+    extra_instruction: str | None = None,
+    model: str = GEMINI_MODEL,
+) -> "Runner":
+    """Return the pooled Runner for this subject/model/key, building it on first use."""
+    key = (extra_instruction or "", model, api_key)
+    runner = _runner_pool.get(key)
+    if runner is not None:
+        _runner_pool.move_to_end(key)
+        return runner
+
+    lib = sdk()
+    with span("runner_build"):
+        runner = lib.Runner(
+            agent=build_agent(api_key=api_key, extra_instruction=extra_instruction, model=model),
+            app_name=APP_NAME,
+            session_service=lib.InMemorySessionService(),
+        )
+    _runner_pool[key] = runner
+    while len(_runner_pool) > RUNNER_POOL_SIZE:
+        _runner_pool.popitem(last=False)
+    return runner
+
+def register_gemini_model(factory: "Callable[[str, str], BaseLlm]"):
+    """Build the Gemini slot's agents on factory(model, api_key) instead of KeyedGemini."""
+    global _gemini_model
+    _gemini_model = factory
+    _runner_pool.clear()
+
+async def gemini_stream(
+    prompt: str,
+    api_key: str,
+    extra_instruction: str | None = None,
+    model: str | None = None,
+) -> AsyncIterator[str]:
+    """Stream text deltas for one prompt from the pooled Gemini runner."""
+    lib = await warm_sdk()
+    runner = get_runner(api_key=api_key, extra_instruction=extra_instruction, model=model or GEMINI_MODEL)
+    # Sessions are per request and dropped afterwards so the pooled
+    # session store does not grow with every generation.
+    with span("session_create"):
+        session = await runner.session_service.create_session(app_name=APP_NAME, user_id=USER_ID)
+    content = lib.types.Content(role="user", parts=[lib.types.Part(text=prompt)])
+
+    # run_async keeps the event loop free while Gemini is generating,
+    # so one worker can serve many requests (and /health) concurrently.
+    events = runner.run_async(
+        user_id=USER_ID,
+        session_id=session.id,
+        new_message=content,
+        run_config=lib.RunConfig(streaming_mode=lib.StreamingMode.SSE),
+    )
+    budget = _output_budget.get()
+    started = time.perf_counter()
+    streamed = False
+    usage = None
+    outcome = "error"
+    try:
+        async for event in events:
+            usage = event.usage_metadata or usage
+            if not (event.content and event.content.parts):
+                continue
+            text = event.content.parts[0].text or ""
+            if event.partial:
+                if not streamed:
+                    FIRST_TOKEN_SECONDS.labels("gemini").observe(time.perf_counter() - started)
+                streamed = True
+                yield text
+            elif event.is_final_response():
+                # The final event repeats the whole text; only needed if nothing was streamed
+                if not streamed:
+                    FIRST_TOKEN_SECONDS.labels("gemini").observe(time.perf_counter() - started)
+                    yield text
+                break
+        outcome = "ok"
+    except (asyncio.CancelledError, GeneratorExit):
+        outcome = "cancelled"
+        raise
+    finally:
+        PROVIDER_SECONDS.labels("gemini", outcome).observe(time.perf_counter() - started)
+        if usage:
+            TOKENS.labels("gemini", "prompt").inc(usage.prompt_token_count or 0)
+            TOKENS.labels("gemini", "completion").inc(usage.candidates_token_count or 0)
+            report_completion("gemini", budget, usage.candidates_token_count)
+        # Close the run in this task so ADK's tracing context unwinds where it was entered
+        await events.aclose()
+        await runner.session_service.delete_session(
+            app_name=APP_NAME, user_id=USER_ID, session_id=session.id
+        )
+
+async def gemini_generate(
+    prompt: str,
+    api_key: str,
+    extra_instruction: str | None = None,
+    on_first_token: Callable[[], None] | None = None,
+    model: str | None = None,
+) -> str:
+    """Full reply of the primary provider for one prompt; on_first_token is called when the first text arrives."""
+    parts = []
+    async for text in _providers["gemini"](prompt, api_key, extra_instruction, model):
+        if on_first_token and not parts:
+            on_first_token()
+        parts.append(text)
+    return "".join(parts)
+
+@functools.cache
+def response_format(model: str) -> dict | None:
+    """LiteLLM response_format: the question schema where the model supports it, plain JSON mode otherwise."""
+    if not STRUCTURED_OUTPUT:
+        return None
+    try:
+        if sdk().supports_response_schema(model=model):
+            return {
+                "type": "json_schema",
+                "json_schema": {"name": "question_set", "schema": QUESTION_SET_SCHEMA, "strict": True},
+            }
+    except Exception:
+        # Unknown to LiteLLM's model map
+        pass
+    return {"type": "json_object"}
+
+async def fallback_stream(
         prompt: str,
         instruction: str,
-        fallback_api_key:str,
-        fallback_model:str = "gpt-3.5-turbo"
-) -> str:
-    """LiteLLM fallback when Gemini quota is exhausted."""
+        fallback_api_key: str,
+        fallback_model: str = "gpt-3.5-turbo"
+) -> AsyncIterator[str]:
+    """LiteLLM fallback, yielding text deltas."""
     messages = [
         {"role": "system", "content": instruction},
         {"role": "user", "content": prompt}
     ]
-    response = await acompletion(
-        model=fallback_model,
-        messages=messages,
-        api_key=fallback_api_key
+    lib = await warm_sdk()
+    budget = _output_budget.get()
+    # Labelled "fallback" rather than by model name, which comes from the request
+    started = time.perf_counter()
+    streamed = False
+    outcome = "error"
+    try:
+        response = await lib.acompletion(
+            model=fallback_model,
+            messages=messages,
+            api_key=fallback_api_key,
+            stream=True,
+            stream_options={"include_usage": True},
+            max_tokens=budget,
+            response_format=response_format(fallback_model),
+            # Providers without JSON mode get the request without it rather than an error
+            drop_params=True,
+        )
+        async for chunk in response:
+            usage = getattr(chunk, "usage", None)
+            if usage:
+                TOKENS.labels("fallback", "prompt").inc(usage.prompt_tokens or 0)
+                TOKENS.labels("fallback", "completion").inc(usage.completion_tokens or 0)
+                report_completion("fallback", budget, usage.completion_tokens)
+            # The usage chunk at the end has no choices
+            text = chunk.choices[0].delta.content if chunk.choices else None
+            if text:
+                if not streamed:
+                    FIRST_TOKEN_SECONDS.labels("fallback").observe(time.perf_counter() - started)
+                streamed = True
+                yield text
+        outcome = "ok"
+    except (asyncio.CancelledError, GeneratorExit):
+        outcome = "cancelled"
+        raise
+    finally:
+        PROVIDER_SECONDS.labels("fallback", outcome).observe(time.perf_counter() - started)
+
+async def litellm_stream(
+    prompt: str,
+    api_key: str,
+    extra_instruction: str | None = None,
+    model: str | None = None,
+) -> AsyncIterator[str]:
+    """fallback_stream with the provider slot signature."""
+    async for text in fallback_stream(prompt, system_instruction(extra_instruction), api_key, model or "gpt-3.5-turbo"):
+        yield text
+
+# Provider slots: "gemini" is the primary, "fallback" the secondary used for
+# hedging and failover. A provider is an async generator function
+# (prompt, api_key, extra_instruction, model) yielding text deltas;
+# agents.fake_provider fills both slots with offline fakes.
+ProviderStream = Callable[[str, str, str | None, str | None], AsyncIterator[str]]
+_providers: dict[str, ProviderStream] = {"gemini": gemini_stream, "fallback": litellm_stream}
+
+def register_provider(slot: str, stream: ProviderStream):
+    """Serve a provider slot ("gemini" or "fallback") from another implementation."""
+    if slot not in _providers:
+        raise ValueError(f"Unknown provider slot: {slot}")
+    _providers[slot] = stream
+
+async def fallback_generate(
+        prompt: str,
+        extra_instruction: str | None,
+        fallback_api_key:str,
+        fallback_model:str = "gpt-3.5-turbo",
+        on_first_token: Callable[[], None] | None = None,
+) -> str:
+    """Fallback provider (LiteLLM) reply, for when Gemini quota is exhausted or too slow."""
+    parts = []
+    async for text in _providers["fallback"](prompt, fallback_api_key, extra_instruction, fallback_model):
+        if on_first_token and not parts:
+            on_first_token()
+        parts.append(text)
+    return "".join(parts)
+
+class ProviderStats:
+    """Rolling latency and error statistics for one provider."""
+
+    def __init__(self, window: int = STATS_WINDOW):
+        self.latencies: deque[float] = deque(maxlen=window)
+        self.first_tokens: deque[float] = deque(maxlen=window)
+        self.outcomes: deque[bool] = deque(maxlen=window)
+
+    def record(self, latency: float, ok: bool):
+        self.outcomes.append(ok)
+        if ok:
+            self.latencies.append(latency)
+
+    def record_first_token(self, latency: float):
+        self.first_tokens.append(latency)
+
+    @staticmethod
+    def _quantile(values, q: float) -> float | None:
+        if len(values) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def first_token_p95(self) -> float | None:
+        return self._quantile(self.first_tokens, 0.95)
+
+    def error_rate(self) -> float:
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def score(self) -> float | None:
+        """Expected seconds to a usable answer; lower is better. None until there are enough samples."""
+        p50 = self._quantile(self.latencies, 0.5)
+        if p50 is None:
+            return None
+        return p50 / max(1.0 - self.error_rate(), 0.05)
+
+def prefers_fallback(fallback: str) -> bool:
+    """True if the fallback has measured a clearly better score than Gemini; unmeasured never outranks Gemini."""
+    gemini_score = provider_stats["gemini"].score()
+    fallback_score = provider_stats[fallback].score()
+    if gemini_score is None or fallback_score is None:
+        return False
+    return fallback_score < gemini_score * HEDGE_SWITCH_RATIO
+
+provider_stats: dict[str, ProviderStats] = defaultdict(ProviderStats)
+
+_RETRY_DELAY = re.compile(r"retryDelay\W+(\d+(?:\.\d+)?)s")
+
+def quota_retry_delay(error: Exception) -> float | None:
+    """Seconds until the quota resets if error is a 429/quota error, else None."""
+    message = str(error)
+    status = getattr(error, "code", None) or getattr(error, "status_code", None)
+    if status != 429 and "RESOURCE_EXHAUSTED" not in message and "429" not in message:
+        return None
+    match = _RETRY_DELAY.search(message)
+    if match:
+        return float(match.group(1))
+    if "PerDay" in message:
+        return CIRCUIT_DAILY_QUOTA_WINDOW
+    return CIRCUIT_QUOTA_WINDOW
+
+class CircuitBreaker:
+    """
+    Closed until a quota error (or CIRCUIT_FAILURE_THRESHOLD other failures in
+    a row) opens it. While open, calls are skipped; once the window has passed
+    a single half-open probe is let through and its outcome closes or reopens it.
+    State lives in shared state, so a quota error seen by one worker stops
+    every worker from spending calls on the same exhausted key.
+    """
+
+    def __init__(self, provider: str, api_key: str, state: SharedState = shared_state):
+        self.key = f"breaker:{provider}:{key_id(api_key)}"
+        self.state = state
+
+    async def available(self) -> bool:
+        open_until = await self.state.get(f"{self.key}:open")
+        if not open_until:
+            return True
+        return time.time() >= open_until and not await self.state.get(f"{self.key}:probe")
+
+    async def begin(self) -> float | None:
+        """
+        Admit one call. None means skip this provider: the circuit is open, or
+        another call already holds the half-open probe. Otherwise returns the
+        call's probe token for release() and record_failure(): 0 while the
+        circuit is closed, or the probe flag this call took.
+        """
+        open_until = await self.state.get(f"{self.key}:open")
+        if not open_until:
+            return 0.0
+        if time.time() < open_until:
+            return None
+        # Unique per call, so only the call holding the probe flag can clear it
+        probe = float(random.getrandbits(52) + 1)
+        if await self.state.set(f"{self.key}:probe", probe, ttl=CIRCUIT_PROBE_TIMEOUT, nx=True):
+            return probe
+        return None
+
+    async def record_success(self):
+        await self.state.delete(f"{self.key}:open", f"{self.key}:failures", f"{self.key}:probe")
+
+    async def record_failure(self, error: Exception, probe: float = 0.0):
+        await self.release(probe)
+        delay = quota_retry_delay(error)
+        if delay is None:
+            failures = await self.state.incr(f"{self.key}:failures", ttl=CIRCUIT_DAILY_QUOTA_WINDOW)
+            if failures < CIRCUIT_FAILURE_THRESHOLD and not await self.state.get(f"{self.key}:open"):
+                return
+            delay = CIRCUIT_COOLDOWN
+        await self.state.delete(f"{self.key}:failures")
+        # Kept past the window so the half-open probe still happens; forgotten a while after that
+        await self.state.set(f"{self.key}:open", time.time() + delay, ttl=delay + CIRCUIT_DAILY_QUOTA_WINDOW)
+
+    async def release(self, probe: float = 0.0):
+        """The call ended without closing the circuit; clear the probe flag if this call holds it."""
+        if probe and await self.state.get(f"{self.key}:probe") == probe:
+            await self.state.delete(f"{self.key}:probe")
+
+    async def retry_in(self) -> float:
+        open_until = await self.state.get(f"{self.key}:open")
+        return max(0.0, open_until - time.time()) if open_until else 0.0
+
+_breakers: "OrderedDict[tuple[str, str], CircuitBreaker]" = OrderedDict()
+
+def get_breaker(provider: str, api_key: str) -> CircuitBreaker:
+    key = (provider, api_key)
+    breaker = _breakers.get(key)
+    if breaker is None:
+        breaker = _breakers[key] = CircuitBreaker(provider, api_key)
+        while len(_breakers) > CIRCUIT_POOL_SIZE:
+            _breakers.popitem(last=False)
+    _breakers.move_to_end(key)
+    return breaker
+
+def hedge_delay(provider: str) -> float | None:
+    """How long to wait for the first token before hedging, from the provider's rolling p95."""
+    if not HEDGE_ENABLED:
+        return None
+    p95 = provider_stats[provider].first_token_p95()
+    if p95 is None:
+        return HEDGE_DEFAULT_DELAY
+    return min(max(p95, HEDGE_MIN_DELAY), HEDGE_MAX_DELAY)
+
+async def _timed(
+    provider: str,
+    api_key: str,
+    call: Callable[[Callable[[], None]], Awaitable[str]],
+    first_token: asyncio.Event,
+) -> str:
+    """Run one provider call, recording its latency, first-token time and outcome."""
+    stats = provider_stats[provider]
+    breaker = get_breaker(provider, api_key)
+    probe = await breaker.begin()
+    if probe is None:
+        raise Exception(f"{provider} circuit is open, retry in {await breaker.retry_in():.0f}s")
+    started = time.perf_counter()
+
+    def on_first_token():
+        stats.record_first_token(time.perf_counter() - started)
+        first_token.set()
+
+    try:
+        text = await call(on_first_token)
+    except asyncio.CancelledError:
+        await breaker.release(probe)
+        raise
+    except Exception as e:
+        stats.record(time.perf_counter() - started, ok=False)
+        await breaker.record_failure(e, probe)
+        raise
+    stats.record(time.perf_counter() - started, ok=True)
+    await breaker.record_success()
+    return text
+
+async def _hedged_generate(
+    prompt: str,
+    api_key: str,
+    fallback_api_key: str,
+    fallback_model: str = "gpt-3.5-turbo",
+    extra_instruction: str | None = None,
+    model: str | None = None,
+) -> str:
+    """
+    Start Gemini, or the fallback if Gemini's circuit is open or the
+    fallback's rolling score is clearly better. If it fails, or has not
+    produced a first token within its p95-derived deadline, start the other
+    one too and take whichever finishes first, cancelling the loser.
+    """
+    calls = {
+        "gemini": lambda on_first_token: gemini_generate(
+            prompt, api_key, extra_instruction, on_first_token, model
+        ),
+        fallback_model: lambda on_first_token: fallback_generate(
+            prompt, extra_instruction, fallback_api_key, fallback_model, on_first_token
+        ),
+    }
+    keys = {"gemini": api_key, fallback_model: fallback_api_key}
+    # Providers with an open circuit are skipped outright instead of retried
+    available = [name for name in calls if await get_breaker(name, keys[name]).available()]
+    if not available:
+        retry_in = min([await get_breaker(name, keys[name]).retry_in() for name in calls])
+        raise Exception(f"All providers are unavailable (quota exhausted), retry in {retry_in:.0f}s")
+    # Gemini goes first unless its circuit is open or the fallback is clearly faster
+    primary, secondary = "gemini", fallback_model
+    if "gemini" not in available or (fallback_model in available and prefers_fallback(fallback_model)):
+        primary, secondary = fallback_model, "gemini"
+    if secondary not in available:
+        secondary = None
+    if "gemini" not in available:
+        FALLBACKS.labels("circuit_open").inc()
+    first_token = asyncio.Event()
+    tasks = {asyncio.create_task(_timed(primary, keys[primary], calls[primary], first_token)): primary}
+
+    waiter = asyncio.create_task(first_token.wait())
+    await asyncio.wait([*tasks, waiter], timeout=hedge_delay(primary), return_when=asyncio.FIRST_COMPLETED)
+    waiter.cancel()
+
+    pending = set(tasks)
+    try:
+        while True:
+            for task in tasks:
+                if task.done() and not task.exception():
+                    return task.result()
+            primary_failed = any(task.done() for task in tasks)
+            if secondary and secondary not in tasks.values() and (primary_failed or not first_token.is_set()):
+                print(f"{primary} {'failed' if primary_failed else 'is slow'}, hedging with {secondary}...")
+                FALLBACKS.labels("error" if primary_failed else "slow").inc()
+                task = asyncio.create_task(
+                    _timed(secondary, keys[secondary], calls[secondary], asyncio.Event())
+                )
+                tasks[task] = secondary
+            pending = {task for task in tasks if not task.done()}
+            if not pending:
+                break
+            await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    errors = []
+    for task, name in tasks.items():
+        errors.append(f"{name}: {task.exception()}")
+    raise Exception("All providers failed: " + "; ".join(errors))
+
+@functools.cache
+def split_instruction(extra_instruction: str) -> tuple[str, list[str], str]:
+    """
+    Split a subject instruction block into (header, topics, rules): the lines
+    before its "ONLY about" topic list, the top-level topics with sub-bullets
+    folded in, and the "Do NOT" lines after it. Blocks without a topic list
+    come back whole as the header.
+    """
+    lines = extra_instruction.strip().splitlines()
+    header = None
+    for i, line in enumerate(lines):
+        if "ONLY about" in line:
+            header, lines = "\n".join(lines[:i]).strip(), lines[i + 1:]
+            break
+
+    items, rules = [], ""
+    for i, line in enumerate(lines):
+        if line.strip().startswith("Do NOT"):
+            rules = "\n".join(lines[i:]).strip()
+            break
+        text = line.strip().lstrip("-").strip().rstrip(".:,")
+        if text:
+            items.append((len(line) - len(line.lstrip()), text))
+    if header is None or not items:
+        return extra_instruction.strip(), [], ""
+
+    top_indent = min(indent for indent, _ in items)
+    topics: list[tuple[str, list[str]]] = []
+    for indent, text in items:
+        if indent == top_indent or not topics:
+            topics.append((text, []))
+        else:
+            topics[-1][1].append(text)
+    return header, [f"{head} ({', '.join(children)})" if children else head for head, children in topics], rules
+
+def extract_topics(extra_instruction: str | None) -> list[str]:
+    """Return the top-level topics listed in a subject instruction block, sub-bullets folded in."""
+    if not extra_instruction:
+        return []
+    return split_instruction(extra_instruction)[1]
+
+def estimate_tokens(text: str) -> int:
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+def select_topics(topics: list[str], num_questions: int) -> list[str]:
+    """
+    A random subset of the topics sized to the request, kept in their listed
+    order. Small requests send a couple of topics instead of the whole list,
+    and the bank still covers every topic over many requests.
+    """
+    count = max(MIN_TOPICS, math.ceil(num_questions * TOPICS_PER_QUESTION))
+    if count >= len(topics):
+        return topics
+    return [topics[i] for i in sorted(random.sample(range(len(topics)), count))]
+
+def output_budget(difficulty: str, num_questions: int) -> int | None:
+    """Max reply tokens for num_questions questions: enough not to truncate, not enough to pad."""
+    if not OUTPUT_BUDGET_ENABLED:
+        return None
+    per_question = OUTPUT_TOKENS_PER_QUESTION.get(difficulty.lower(), OUTPUT_TOKENS_PER_QUESTION["medium"])
+    return math.ceil((num_questions * per_question + OUTPUT_TOKEN_OVERHEAD) * OUTPUT_TOKEN_MARGIN)
+
+def build_prompt(
+    subject: str,
+    difficulty: str,
+    num_questions: int,
+    topics: list[str] | None = None,
+    extra_instruction: str | None = None,
+) -> str:
+    """
+    User prompt for one generation. With compaction, extra_instruction is sent
+    here rather than in the system instruction: its header and rules, and
+    only the topics picked for this request out of `topics` (or all of them).
+    """
+    ask = f"Generate {num_questions} {difficulty} difficulty MCQ questions on {subject}"
+    if not (PROMPT_COMPACTION and extra_instruction):
+        prompt = ask + ". "
+        # The full list already travels in the system instruction
+        if topics and topics != extract_topics(extra_instruction):
+            prompt += "Focus on these topics: " + "; ".join(topics) + ". "
+        return prompt + "Follow the JSON format described in your instructions."
+
+    header, all_topics, rules = split_instruction(extra_instruction)
+    picked = select_topics(topics or all_topics, num_questions)
+    lines = [header]
+    if picked:
+        lines.append(ask + ", ONLY about these topics:")
+        lines.extend(f"- {topic}" for topic in picked)
+    else:
+        lines.append(ask + ".")
+    if rules:
+        lines.append(rules)
+    lines.append("Follow the JSON format described in your instructions.")
+    return "\n".join(lines)
+
+def prompt_tokens_saved(extra_instruction: str | None, prompts: list[str]) -> int:
+    """
+    Estimated prompt tokens the compacted prompts save over the uncompacted
+    ones, which sent the whole subject block as the system instruction of
+    every call. Shard topic hints are left out of that baseline, so this
+    errs low.
+    """
+    if not (PROMPT_COMPACTION and extra_instruction):
+        return 0
+    uncompacted = estimate_tokens(extra_instruction) + estimate_tokens(build_prompt("", "", 0))
+    return sum(uncompacted - estimate_tokens(prompt) for prompt in prompts)
+
+def plan_shards(
+    num_questions: int,
+    topics: list[str] | None = None,
+    shard_size: int | None = None,
+) -> list[tuple[int, list[str]]]:
+    """Split a request into (question count, slice of topics) shards of at most shard_size questions."""
+    shard_size = shard_size or SHARD_SIZE
+    if num_questions <= shard_size:
+        return [(num_questions, [])]
+    num_shards = -(-num_questions // shard_size)
+    counts = [num_questions // num_shards + (i < num_questions % num_shards) for i in range(num_shards)]
+    topics = topics or []
+    return [(count, topics[i::num_shards]) for i, count in enumerate(counts)]
+
+def _question_key(question: dict) -> str:
+    """Normalized question text used to drop duplicates across shards."""
+    return re.sub(r"\W+", " ", str(question.get("question", "")).lower()).strip()
+
+async def _generate_once(
+    prompt: str,
+    api_key: str,
+    fallback_api_key: str | None = None,
+    fallback_model: str = "gpt-3.5-turbo",
+    extra_instruction: str | None = None,
+    model: str | None = None,
+) -> str:
+    """One generation for the prompt: Gemini alone, or hedged against LiteLLM when a fallback key is given."""
+    if not fallback_api_key:
+        breaker = get_breaker("gemini", api_key)
+        if not await breaker.available():
+            raise Exception(
+                f"Gemini quota exhausted, retry in {await breaker.retry_in():.0f}s. No fallback API key provided."
+            )
+        try:
+            return await _timed(
+                "gemini",
+                api_key,
+                lambda on_first_token: gemini_generate(
+                    prompt, api_key, extra_instruction, on_first_token, model
+                ),
+                asyncio.Event(),
+            )
+        except Exception as e:
+            raise Exception(f"Gemini failed: {e}. No fallback API key provided.")
+
+    return await _hedged_generate(
+        prompt=prompt,
+        api_key=api_key,
+        fallback_api_key=fallback_api_key,
+        fallback_model=fallback_model,
+        extra_instruction=extra_instruction,
+        model=model,
     )
-    return response.choices[0].message.content
-     
+
+def report_prompts(subject: str, extra_instruction: str | None, prompts: list[str], budgets: list[int | None]):
+    """Log the prompt size, compaction savings and output budget of one request."""
+    saved = prompt_tokens_saved(extra_instruction, prompts)
+    if saved:
+        TOKENS_SAVED.labels(subject).inc(saved)
+    if not LOG_PROMPTS:
+        return
+    budget = sum(budgets) if all(budgets) else None
+    print(
+        f"{subject}: {len(prompts)} prompt(s), ~{sum(map(estimate_tokens, prompts))} tokens "
+        f"(~{saved} saved by compaction), output budget {budget or 'provider default'}"
+    )
+
+def report_completion(provider: str, budget: int | None, completion_tokens: int | None):
+    """Record how much of the output budget a reply used; the rest counts as output tokens saved."""
+    if not (budget and completion_tokens):
+        return
+    saved = max(0, budget - completion_tokens)
+    OUTPUT_BUDGET_USE.labels(provider).observe(completion_tokens / budget)
+    OUTPUT_TOKENS_SAVED.labels(provider).inc(saved)
+    if LOG_PROMPTS:
+        print(f"{provider}: {completion_tokens} completion tokens of a {budget} output budget ({saved} saved)")
+
+async def _generate_shard(prompt: str, max_output_tokens: int | None = None, **kwargs) -> list[dict]:
+    """Generate and parse one shard, retrying only this shard on failure."""
+    # Runs as its own task, so the budget only applies to this shard's calls
+    _output_budget.set(max_output_tokens)
+    error = None
+    for attempt in range(SHARD_ATTEMPTS):
+        if attempt:
+            RETRIES.inc()
+        try:
+            questions = parse_llm_response(await _generate_once(prompt, **kwargs)).get("questions", [])
+            if questions:
+                return questions
+            error = ValueError("shard returned no questions")
+        except Exception as e:
+            error = e
+    raise error
 
 async def generate_questions(
     subject: str,
@@ -89,74 +910,175 @@ async def generate_questions(
     fallback_api_key: str | None = None,
     fallback_model: str = "gpt-3.5-turbo",
     extra_instruction: str | None = None,
+    shard_size: int | None = None,
+    model: str | None = None,
+    topics: list[str] | None = None,
 ) -> str:
     """
     Main function your API/frontend will call.
     Returns the raw text from Gemini (later you will parse JSON from it).
+    Requests larger than shard_size are generated as concurrent shards, each
+    focused on a slice of the subject's topics, and merged into one JSON text.
+    topics defaults to the topic list in extra_instruction.
     """
     effective_api_key = api_key or os.getenv("GEMINI_API_KEY")
 
     if not effective_api_key:
         raise Exception("No Gemini API key provided")
-    os.environ["GEMINI_API_KEY"] = effective_api_key
-    prompt = (
-        f"Generate {num_questions} {difficulty} difficulty MCQ questions on {subject}. "
-        "Follow the JSON format described in your instructions."
-    )
-
-    instruction = BASE_INSTRUCTION
-    if extra_instruction:
-        instruction = BASE_INSTRUCTION + "\n\n" + extra_instruction
-
-    #Gemini
-    try:
-        session_service = InMemorySessionService()
-        app_name = "agents"
-        user_id = "user1"
-        session_id = "mcq_session"
-
-        await session_service.create_session(
-            app_name=app_name,
-            user_id=user_id,
-            session_id=session_id,
-        )
 
-        agent = build_agent(extra_instruction=extra_instruction)
-        runner = Runner(agent=agent, app_name=app_name, session_service=session_service)
-        content = types.Content(
-            role="user",
-            parts=[types.Part(text=prompt)],
-        )
+    kwargs = dict(
+        api_key=effective_api_key,
+        fallback_api_key=fallback_api_key,
+        fallback_model=fallback_model,
+        # With compaction the subject block travels in the prompt instead
+        extra_instruction=None if PROMPT_COMPACTION else extra_instruction,
+        model=model,
+    )
+    if topics is None:
+        topics = extract_topics(extra_instruction)
+    shards = plan_shards(num_questions, topics, shard_size)
+    prompts = [
+        build_prompt(subject, difficulty, count, topic_slice or topics, extra_instruction)
+        for count, topic_slice in shards
+    ]
+    budgets = [output_budget(difficulty, count) for count, _ in shards]
+    report_prompts(subject, extra_instruction, prompts, budgets)
+    if len(shards) == 1:
+        token = _output_budget.set(budgets[0])
+        try:
+            return await _generate_once(prompts[0], **kwargs)
+        finally:
+            _output_budget.reset(token)
 
-        final_text = ""
-        for event in runner.run(
-            user_id=user_id,
-            session_id=session_id,
-            new_message=content,
-        ):
-            if (
-                hasattr(event, "is_final_response")
-                and event.is_final_response()
-                and hasattr(event, "content")
-                and event.content
-            ):
-                final_text = event.content.parts[0].text
-                break
+    results = await asyncio.gather(
+        *(_generate_shard(prompt, budget, **kwargs) for prompt, budget in zip(prompts, budgets)),
+        return_exceptions=True,
+    )
+    failures = [r for r in results if isinstance(r, BaseException)]
+    if len(failures) == len(results):
+        raise failures[0]
 
-        return final_text
+    merged, seen = [], set()
+    for shard in results:
+        if isinstance(shard, BaseException):
+            continue
+        for question in shard:
+            key = _question_key(question)
+            if key in seen:
+                continue
+            seen.add(key)
+            merged.append({**question, "id": len(merged) + 1})
+    return json.dumps({"questions": merged[:num_questions]})
 
-    #LiteLLM fallback
+async def _stream_once(
+    prompt: str,
+    api_key: str,
+    fallback_api_key: str | None = None,
+    fallback_model: str = "gpt-3.5-turbo",
+    extra_instruction: str | None = None,
+    model: str | None = None,
+) -> AsyncIterator[str]:
+    """Stream text deltas for one prompt from Gemini, or from LiteLLM if Gemini fails before any output."""
+    streamed = False
+    breaker = get_breaker("gemini", api_key)
+    probe = await breaker.begin()
+    try:
+        if probe is None:
+            raise Exception(f"Gemini quota exhausted, retry in {await breaker.retry_in():.0f}s")
+        try:
+            async for text in _providers["gemini"](prompt, api_key, extra_instruction, model):
+                streamed = True
+                yield text
+        except (asyncio.CancelledError, GeneratorExit):
+            await breaker.release(probe)
+            raise
+        except Exception as e:
+            await breaker.record_failure(e, probe)
+            raise
+        await breaker.record_success()
     except Exception as e:
+        if streamed:
+            raise
         if not fallback_api_key:
             raise Exception(f"Gemini failed: {e}. No fallback API key provided.")
-        
         print(f"Gemini failed ({e}), falling back to LiteLLM...")
-        return await fallback_generate(
-            prompt=prompt,
-            instruction=instruction,
-            fallback_api_key=fallback_api_key,
-            fallback_model=fallback_model
-        )
+        FALLBACKS.labels("circuit_open" if probe is None else "error").inc()
+        async for text in _providers["fallback"](prompt, fallback_api_key, extra_instruction, fallback_model):
+            yield text
+
+_SHARD_DONE = object()
+
+async def stream_questions(
+    subject: str,
+    difficulty: str,
+    num_questions: int,
+    api_key: str | None = None,
+    fallback_api_key: str | None = None,
+    fallback_model: str = "gpt-3.5-turbo",
+    extra_instruction: str | None = None,
+    shard_size: int | None = None,
+    model: str | None = None,
+    topics: list[str] | None = None,
+) -> AsyncIterator[dict]:
+    """
+    Streaming counterpart of generate_questions. Yields parsed question dicts,
+    renumbered and deduplicated, as soon as each one is complete in any shard.
+    """
+    effective_api_key = api_key or os.getenv("GEMINI_API_KEY")
+
+    if not effective_api_key:
+        raise Exception("No Gemini API key provided")
+
+    kwargs = dict(
+        api_key=effective_api_key,
+        fallback_api_key=fallback_api_key,
+        fallback_model=fallback_model,
+        extra_instruction=None if PROMPT_COMPACTION else extra_instruction,
+        model=model,
+    )
+    queue: asyncio.Queue = asyncio.Queue()
+    if topics is None:
+        topics = extract_topics(extra_instruction)
+    shards = plan_shards(num_questions, topics, shard_size)
+    prompts = [
+        build_prompt(subject, difficulty, count, topic_slice or topics, extra_instruction)
+        for count, topic_slice in shards
+    ]
+    budgets = [output_budget(difficulty, count) for count, _ in shards]
+    report_prompts(subject, extra_instruction, prompts, budgets)
+
+    async def pump(prompt: str, budget: int | None):
+        _output_budget.set(budget)
+        parser = QuestionStreamParser()
+        try:
+            async for text in _stream_once(prompt, **kwargs):
+                for question in parser.feed(text):
+                    await queue.put(question)
+            await queue.put(_SHARD_DONE)
+        except Exception as e:
+            await queue.put(e)
+
+    tasks = [asyncio.create_task(pump(prompt, budget)) for prompt, budget in zip(prompts, budgets)]
+    seen, errors, finished, sent = set(), [], 0, 0
+    try:
+        while finished < len(tasks) and sent < num_questions:
+            item = await queue.get()
+            if item is _SHARD_DONE or isinstance(item, Exception):
+                finished += 1
+                if item is not _SHARD_DONE:
+                    errors.append(item)
+                continue
+            key = _question_key(item)
+            if key in seen:
+                continue
+            seen.add(key)
+            sent += 1
+            yield {**item, "id": sent}
+    finally:
+        for task in tasks:
+            task.cancel()
+    if not sent and errors:
+        raise errors[0]
 
 # Optional: keep a local test entry point
 async def _test():
@@ -167,5 +1089,52 @@ async def _test():
     )
     print(text)
 
+async def _bench_setup(iterations: int = 200):
+    """Compare per-request agent/runner/session setup against the pooled path."""
+    api_key = os.getenv("GEMINI_API_KEY", "bench")
+    started = time.perf_counter()
+    lib = sdk()
+    for _ in range(iterations):
+        session_service = lib.InMemorySessionService()
+        session = await session_service.create_session(app_name=APP_NAME, user_id=USER_ID)
+        lib.Runner(agent=build_agent(api_key=api_key), app_name=APP_NAME, session_service=session_service)
+        # A fresh Gemini model also built its own genai Client (and HTTP pool) on first use
+        lib.Client(api_key=api_key, http_options=lib.types.HttpOptions(retry_options=lib.retry_config))
+    per_request = (time.perf_counter() - started) / iterations
+
+    get_runner(api_key=api_key)
+    started = time.perf_counter()
+    for _ in range(iterations):
+        runner = get_runner(api_key=api_key)
+        session = await runner.session_service.create_session(app_name=APP_NAME, user_id=USER_ID)
+        await runner.session_service.delete_session(
+            app_name=APP_NAME, user_id=USER_ID, session_id=session.id
+        )
+    pooled = (time.perf_counter() - started) / iterations
+
+    print(f"setup per request: fresh {per_request * 1000:.3f} ms, pooled {pooled * 1000:.3f} ms")
+
+def _bench_prompts():
+    """Estimated prompt tokens per request, uncompacted vs compacted, and the output budget, for every subject."""
+    from agents.registry import all_subjects, load_subjects
+    load_subjects()
+    for spec in all_subjects():
+        row = []
+        for num_questions in (1, 10, 40):
+            shards = plan_shards(num_questions, spec.topics, spec.shard_size)
+            prompts = [
+                build_prompt(spec.name, "medium", count, topics or spec.topics, spec.instruction)
+                for count, topics in shards
+            ]
+            compact = sum(estimate_tokens(BASE_INSTRUCTION) + estimate_tokens(p) for p in prompts)
+            saved = prompt_tokens_saved(spec.instruction, prompts)
+            row.append(f"{num_questions}q {compact + saved}->{compact} in, {output_budget('medium', num_questions)} out")
+        print(f"{spec.id:10} " + " | ".join(row))
+
 if __name__ == "__main__" and os.getenv("ENV") == "local":
-    asyncio.run(_test())
+    if sys.argv[1:] == ["bench"]:
+        asyncio.run(_bench_setup())
+    elif sys.argv[1:] == ["prompts"]:
+        _bench_prompts()
+    else:
+        asyncio.run(_test())
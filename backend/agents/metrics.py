@@ -0,0 +1,204 @@
+import os
+import time
+import bisect
+import contextvars
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from cache hits up to slow 40-question generations
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80)
+
+_metrics: list["Counter | Histogram"] = []
+
+class Counter:
+    """
+    Prometheus-style counter. Children per label set are cached, so a hot
+    path costs one dict lookup and an add. Updated from the event loop only.
+    """
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self._children: dict[tuple, _CounterChild] = {}
+        _metrics.append(self)
+
+    def labels(self, *values) -> "_CounterChild":
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = _CounterChild()
+        return child
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def samples(self):
+        for values, child in self._children.items():
+            yield self.name, dict(zip(self.label_names, values)), child.value
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+class Histogram:
+    """Prometheus-style histogram with fixed buckets, same child caching as Counter."""
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.buckets = tuple(buckets)
+        self._children: dict[tuple, _HistogramChild] = {}
+        _metrics.append(self)
+
+    def labels(self, *values) -> "_HistogramChild":
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = _HistogramChild(self.buckets)
+        return child
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def samples(self):
+        for values, child in self._children.items():
+            labels = dict(zip(self.label_names, values))
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), child.counts):
+                cumulative += count
+                yield f"{self.name}_bucket", {**labels, "le": str(bound)}, cumulative
+            yield f"{self.name}_sum", labels, child.sum
+            yield f"{self.name}_count", labels, child.count
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _metrics:
+        kind = "histogram" if isinstance(metric, Histogram) else "counter"
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{_format_labels(labels)} {value:g}")
+    return "\n".join(lines) + "\n"
+
+REQUEST_SECONDS = Histogram(
+    "mcq_request_seconds", "End-to-end request latency.", ("route", "subject", "difficulty")
+)
+STAGE_SECONDS = Histogram("mcq_stage_seconds", "Time spent per pipeline stage.", ("stage",))
+PROVIDER_SECONDS = Histogram(
+    "mcq_provider_seconds", "Full provider call latency.", ("provider", "outcome")
+)
+FIRST_TOKEN_SECONDS = Histogram(
+    "mcq_provider_first_token_seconds", "Time to the first streamed text per provider.", ("provider",)
+)
+QUESTIONS = Counter("mcq_questions_total", "Questions served, by where they came from.", ("subject", "source"))
+TOKENS = Counter("mcq_tokens_total", "LLM tokens used, as reported by the provider.", ("provider", "kind"))
+RETRIES = Counter("mcq_retries_total", "Shard generations retried after a failure.")
+FALLBACKS = Counter("mcq_fallbacks_total", "Calls sent to the secondary provider.", ("reason",))
+ADMISSIONS = Counter(
+    "mcq_admissions_total", "Admission decisions: admitted, rate_limited_ip/key, queue_full, queue_timeout.", ("result",)
+)
+INVALID_QUESTIONS = Counter(
+    "mcq_invalid_questions_total",
+    "Generated questions dropped by validation: schema, missing_field, bad_options, bad_answer, empty_text, duplicate_options.",
+    ("subject", "reason"),
+)
+RESPONSE_BYTES = Counter(
+    "mcq_response_bytes_total", "JSON response body bytes, raw and as sent after compression.", ("stage",)
+)
+SHARED_STATE_ERRORS = Counter(
+    "mcq_shared_state_errors_total", "Shared state operations that failed and were treated as a miss.", ("operation",)
+)
+DUPLICATES = Counter("mcq_duplicates_total", "Generated questions dropped as near-duplicates.", ("subject",))
+TOKENS_SAVED = Counter(
+    "mcq_tokens_saved_total", "Estimated prompt tokens saved by prompt compaction.", ("subject",)
+)
+OUTPUT_TOKENS_SAVED = Counter(
+    "mcq_output_tokens_saved_total", "Output budget minus the completion tokens replies actually used.", ("provider",)
+)
+# Share of the output budget a reply used; replies near 1.0 risk truncation
+BUDGET_BUCKETS = (0.25, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0, 1.25)
+OUTPUT_BUDGET_USE = Histogram(
+    "mcq_output_budget_use", "Completion tokens as a fraction of the output budget.", ("provider",), BUDGET_BUCKETS
+)
+PARSES = Counter(
+    "mcq_parse_total",
+    "parse_llm_response results: clean (schema-valid), unvalidated, repaired, salvaged (truncated) or failed.",
+    ("result",),
+)
+
+# Spans of the current request, shared with the tasks it starts (shards, hedges)
+_trace: contextvars.ContextVar[list | None] = contextvars.ContextVar("mcq_trace", default=None)
+
+def start_trace() -> list[tuple[str, float]]:
+    """Begin collecting (stage, seconds) spans for the current request."""
+    spans: list[tuple[str, float]] = []
+    _trace.set(spans)
+    return spans
+
+def record_span(stage: str, seconds: float):
+    STAGE_SECONDS.labels(stage).observe(seconds)
+    spans = _trace.get()
+    if spans is not None:
+        spans.append((stage, seconds))
+
+@contextmanager
+def span(stage: str):
+    """Time a pipeline stage into mcq_stage_seconds and the current request's trace."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(stage, time.perf_counter() - started)
+
+def server_timing(spans: list[tuple[str, float]]) -> str:
+    """Spans as a Server-Timing header value, so slow requests can be read off in browser devtools."""
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in spans)
+
+def _bench(iterations: int = 200_000):
+    """Per-call cost of the instrumentation, against a 1s generation."""
+    started = time.perf_counter()
+    for _ in range(iterations):
+        with span("bench"):
+            pass
+    per_span = (time.perf_counter() - started) / iterations
+
+    started = time.perf_counter()
+    for _ in range(iterations):
+        REQUEST_SECONDS.labels("bench", "java", "easy").observe(0.3)
+        TOKENS.labels("bench", "prompt").inc(120)
+    per_update = (time.perf_counter() - started) / iterations / 2
+
+    # Generous upper bound for a sharded 40-question request
+    per_request = 30 * per_span + 45 * per_update
+    print(f"span {per_span * 1e6:.2f} us, metric update {per_update * 1e6:.2f} us")
+    print(f"~{per_request * 1e6:.0f} us per request = {per_request:.4%} of a 1s generation")
+
+if __name__ == "__main__" and os.getenv("ENV") == "local":
+    _bench()
@@ -1,5 +1,6 @@
 import os
 from agents.mcq_agent import generate_questions as base_generate
+from agents.registry import SubjectSpec, register_subject
 
 MONGODB_INSTRUCTION = """
 You are an expert in MongoDB and NoSQL document-based database design.
@@ -58,6 +59,12 @@ Do NOT include questions about SQL databases (MySQL, PostgreSQL), Python, Java,
 Use small MongoDB shell or JSON-style code snippets when useful
 """
 
+register_subject(SubjectSpec(
+    id="mongodb",
+    name="Mongodb",
+    instruction=MONGODB_INSTRUCTION,
+))
+
 async def generate_mongodb_questions(
     difficulty: str,
     num_questions: int,
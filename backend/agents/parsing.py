@@ -0,0 +1,188 @@
+import os
+import re
+import json
+import time
+from typing import Dict, Any
+from pydantic import ValidationError
+from agents.metrics import PARSES
+from agents.schema import QUESTION_SET
+
+# Only these characters change the scanner state; everything else is skipped at C speed
+_SPECIAL = re.compile(r'["\\{}\[\]]')
+
+def _strip_trailing_commas(text: str) -> str:
+    """Drop commas directly before a closing brace/bracket, leaving string contents alone."""
+    out = []
+    comma = None
+    in_string = escape = False
+    for char in text:
+        if in_string:
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+            comma = None
+        elif char == ",":
+            comma = len(out)
+        elif char in "}]":
+            if comma is not None:
+                out[comma] = ""
+            comma = None
+        elif not char.isspace():
+            comma = None
+        out.append(char)
+    return "".join(out)
+
+def _loads(text: str) -> Any:
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return json.loads(_strip_trailing_commas(text))
+
+def _is_question(obj: Any) -> bool:
+    return isinstance(obj, dict) and "question" in obj and "options" in obj
+
+class QuestionStreamParser:
+    """
+    Incrementally scans streamed LLM text and returns each question object
+    as soon as its closing brace arrives, without waiting for the full reply.
+    Quotes only open strings inside a JSON value, so code fences and prose
+    around the JSON are ignored. Once a complete top-level {"questions": [...]}
+    object (or a bare list of questions) has been seen it is kept in .document.
+    """
+
+    def __init__(self):
+        self.document: Dict[str, Any] | None = None
+        self._buf = ""
+        self._pos = 0
+        self._skip = 0
+        self._stack: list[int] = []
+        self._in_string = False
+
+    def feed(self, chunk: str) -> list[Dict[str, Any]]:
+        self._buf += chunk
+        found = []
+        buf = self._buf
+        for match in _SPECIAL.finditer(buf, self._pos):
+            i = match.start()
+            if i < self._skip:
+                continue
+            char = buf[i]
+            if self._in_string:
+                if char == "\\":
+                    self._skip = i + 2
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = bool(self._stack)
+            elif char in "{[":
+                self._stack.append(i)
+            elif char == "\\":
+                continue
+            elif self._stack:
+                start = self._stack.pop()
+                if (buf[start] == "{") != (char == "}"):
+                    # Mismatched bracket: not JSON we can use, start over from here
+                    self._stack.clear()
+                    continue
+                if char == "]" and self._stack:
+                    continue
+                try:
+                    obj = _loads(buf[start:i + 1])
+                except json.JSONDecodeError:
+                    continue
+                if _is_question(obj):
+                    found.append(obj)
+                elif not self._stack and self.document is None:
+                    if isinstance(obj, dict) and isinstance(obj.get("questions"), list):
+                        self.document = obj
+                    elif isinstance(obj, list) and obj and all(_is_question(q) for q in obj):
+                        self.document = {"questions": obj}
+
+        if self._stack:
+            self._pos = len(buf)
+        else:
+            self._buf, self._pos, self._skip = "", 0, 0
+        return found
+
+def parse_llm_response(raw: str) -> Dict[str, Any]:
+    """
+    Extract and parse JSON from LLM response robustly.
+    Structured output takes the fast path: one pass of the compiled schema
+    validator straight from the text. Anything else (code fences, prose
+    around the JSON, trailing commas) goes through one pass of the
+    string-aware scanner. If the reply was cut off, every complete question
+    object is salvaged and the result is marked "truncated".
+    """
+    text = raw.strip()
+    if text.startswith("{"):
+        try:
+            parsed = QUESTION_SET.validate_json(text)
+            PARSES.labels("clean").inc()
+            return parsed
+        except ValidationError as e:
+            # Valid JSON that does not match the schema is passed on as before
+            if not any(error["type"] == "json_invalid" for error in e.errors()):
+                parsed = json.loads(text)
+                if isinstance(parsed, dict):
+                    PARSES.labels("unvalidated").inc()
+                    return parsed
+
+    parser = QuestionStreamParser()
+    questions = parser.feed(raw)
+    if parser.document is not None:
+        PARSES.labels("repaired").inc()
+        return parser.document
+    if questions:
+        PARSES.labels("salvaged").inc()
+        return {"questions": questions, "truncated": True}
+
+    PARSES.labels("failed").inc()
+    raise ValueError("Could not parse valid JSON from LLM response")
+
+def _bench_corpus() -> list[tuple[str, str, int]]:
+    """(name, raw LLM output, questions recoverable) covering real and malformed replies."""
+    def question(i: int, text: str = "What does {x} print?") -> dict:
+        return {
+            "id": i,
+            "question": f"{text} ({i})",
+            "options": {"A": "1", "B": "}", "C": '"{"', "D": "None of the above"},
+            "correct_answer": "A",
+            "explanation": "Braces and \"quotes\" inside strings must not confuse the parser.",
+        }
+
+    questions = [question(i) for i in range(1, 41)]
+    clean = json.dumps({"questions": questions}, indent=2)
+    code = [question(i, "```java\nclass A { void f() { System.out.println(5/2); } }\n```") for i in range(1, 11)]
+    return [
+        ("structured", json.dumps({"questions": questions}), 40),
+        ("clean", clean, 40),
+        ("fenced", "```json\n" + clean + "\n```", 40),
+        ("prose", "Sure! Here are your {40} questions:\n\n" + clean + "\n\nLet me know if you need more.", 40),
+        ("trailing_commas", clean.replace('"\n    }', '",\n    }').replace("}\n  ]", "},\n  ]"), 40),
+        ("truncated", clean[: len(clean) * 3 // 4], 30),
+        ("truncated_fenced", "```json\n" + clean[: len(clean) // 3], 13),
+        ("bare_list", json.dumps(questions[:5]), 5),
+        ("code_snippets", "```json\n" + json.dumps({"questions": code}) + "\n```", 10),
+        ("garbage", "I'm sorry, I can't help with that.", 0),
+    ]
+
+def _bench(rounds: int = 200):
+    """Parse time and recovery rate over the corpus."""
+    for name, raw, expected in _bench_corpus():
+        started = time.perf_counter()
+        for _ in range(rounds):
+            try:
+                recovered = len(parse_llm_response(raw).get("questions", []))
+            except ValueError:
+                recovered = 0
+        per_parse = (time.perf_counter() - started) / rounds
+        rate = recovered / expected if expected else float(recovered == 0)
+        print(f"{name:<18} {len(raw):>7} chars  {per_parse * 1000:8.3f} ms  recovered {recovered}/{expected} ({rate:.0%})")
+
+if __name__ == "__main__" and os.getenv("ENV") == "local":
+    _bench()
@@ -1,5 +1,6 @@
 import os
 from agents.mcq_agent import generate_questions as base_generate
+from agents.registry import SubjectSpec, register_subject
 
 PYTHON_INSTRUCTION = """
 You are an expert in Python programming.
@@ -17,6 +18,12 @@ Do NOT include questions about Java or other languages.
 Use small code snippets when useful.
 """
 
+register_subject(SubjectSpec(
+    id="python",
+    name="Python",
+    instruction=PYTHON_INSTRUCTION,
+))
+
 async def generate_python_questions(
     difficulty: str,
     num_questions: int,
@@ -1,5 +1,6 @@
 import os
 from agents.mcq_agent import generate_questions as base_generate
+from agents.registry import SubjectSpec, register_subject
 
 R_INSTRUCTION = """
 You are an expert in R programming.
@@ -20,6 +21,12 @@ Generate questions ONLY about R:
 Do NOT include questions about Python, Java, or other programming languages. Use small shell command snippets when useful.
 """
 
+register_subject(SubjectSpec(
+    id="r",
+    name="r",
+    instruction=R_INSTRUCTION,
+))
+
 async def generate_r_questions(
     difficulty: str,
     num_questions: int,
@@ -0,0 +1,43 @@
+import pkgutil
+import importlib
+from dataclasses import dataclass, field
+from agents.mcq_agent import extract_topics
+
+@dataclass(frozen=True)
+class SubjectSpec:
+    """A subject the API can generate questions for, plus its generation tuning."""
+    id: str
+    name: str  # subject name used in the prompt
+    instruction: str
+    aliases: tuple[str, ...] = ()
+    model: str | None = None  # Gemini model; None uses mcq_agent.GEMINI_MODEL
+    shard_size: int | None = None  # None uses MCQ_SHARD_SIZE
+    fresh_ratio: float | None = None  # share generated fresh vs. served from the bank; None uses the bank default
+    default_num_questions: int = 10
+    max_questions: int = 40
+    topics: list[str] = field(default_factory=list)
+
+    def __post_init__(self):
+        if not self.topics:
+            object.__setattr__(self, "topics", extract_topics(self.instruction))
+
+_subjects: dict[str, SubjectSpec] = {}
+
+def register_subject(spec: SubjectSpec) -> SubjectSpec:
+    """Make a subject reachable by its id and aliases. Called by each agents/*_agent.py module."""
+    for name in (spec.id, *spec.aliases):
+        _subjects[name.lower()] = spec
+    return spec
+
+def get_subject(name: str) -> SubjectSpec | None:
+    return _subjects.get(name.lower().strip())
+
+def all_subjects() -> list[SubjectSpec]:
+    return list({spec.id: spec for spec in _subjects.values()}.values())
+
+def load_subjects():
+    """Import every module in the agents package so the subject modules register themselves."""
+    import agents
+    for module in pkgutil.iter_modules(agents.__path__):
+        if not module.ispkg:
+            importlib.import_module(f"agents.{module.name}")
@@ -0,0 +1,124 @@
+import os
+import re
+from typing import Any, Literal
+from typing_extensions import TypedDict  # pydantic needs this one below Python 3.12
+from pydantic import TypeAdapter, ValidationError
+from agents.metrics import INVALID_QUESTIONS
+
+# Ask both providers for schema-constrained JSON instead of free text
+STRUCTURED_OUTPUT = os.getenv("MCQ_STRUCTURED_OUTPUT", "1") == "1"
+# Shorter question texts are treated as empty
+MIN_QUESTION_CHARS = 8
+
+LETTERS = ("A", "B", "C", "D")
+# A bare option letter: "B", "b", "B)", "B.", "(B)", "Option B"
+_LETTER_FORM = re.compile(r"^(?:option\s+)?\(?([A-D])\s*[).:]?$", re.IGNORECASE)
+# A letter followed by that option's text: "B) O(log n)"
+_LETTER_AND_TEXT = re.compile(r"^\(?([A-D])\s*[).:]\s+(.+)$", re.IGNORECASE | re.DOTALL)
+
+class Options(TypedDict):
+    A: str
+    B: str
+    C: str
+    D: str
+
+class Question(TypedDict):
+    id: int
+    question: str
+    options: Options
+    correct_answer: Literal["A", "B", "C", "D"]
+    explanation: str
+
+class QuestionSet(TypedDict):
+    questions: list[Question]
+
+# Built once: validating with the compiled adapter skips the json.loads and
+# dict walking of the heuristic path, and yields plain dicts like it does
+QUESTION_SET = TypeAdapter(QuestionSet)
+QUESTION = TypeAdapter(Question)
+
+def _inline(schema: dict, defs: dict) -> dict:
+    """JSON Schema with $refs replaced by their definitions; not every provider resolves $defs."""
+    if "$ref" in schema:
+        return _inline(defs[schema["$ref"].split("/")[-1]], defs)
+    out = {}
+    for key, value in schema.items():
+        if key in ("$defs", "title"):
+            continue
+        if isinstance(value, dict):
+            value = {k: _inline(v, defs) for k, v in value.items()} if key == "properties" else _inline(value, defs)
+        out[key] = value
+    if out.get("type") == "object":
+        # Required by OpenAI strict mode, and keeps Gemini from adding fields
+        out["additionalProperties"] = False
+    return out
+
+def _schema() -> dict:
+    schema = QUESTION_SET.json_schema()
+    return _inline(schema, schema.get("$defs", {}))
+
+QUESTION_SET_SCHEMA = _schema()
+
+def _repair(question: dict) -> dict:
+    """Cheap fixes for shapes models commonly get slightly wrong: option lists, "a)" keys, "B)" or option-text answers."""
+    question = dict(question)
+    options = question.get("options")
+    if isinstance(options, list) and len(options) == 4:
+        options = dict(zip(LETTERS, options))
+    if isinstance(options, dict):
+        options = {
+            (match.group(1).upper() if (match := _LETTER_FORM.match(str(key).strip())) else key): str(text).strip()
+            for key, text in options.items()
+        }
+        question["options"] = options
+
+    answer = question.get("correct_answer")
+    if isinstance(answer, str):
+        answer = answer.strip()
+        texts = {text.lower(): letter for letter, text in options.items()} if isinstance(options, dict) else {}
+        # The option's text first: an answer like "a set" is text, not the letter a
+        if answer.lower() in texts:
+            answer = texts[answer.lower()]
+        elif match := _LETTER_FORM.match(answer):
+            answer = match.group(1).upper()
+        elif (match := _LETTER_AND_TEXT.match(answer)) and texts.get(match.group(2).strip().lower()) == match.group(1).upper():
+            answer = match.group(1).upper()
+        question["correct_answer"] = answer
+    question.setdefault("id", 0)
+    return question
+
+def check_question(question: Any) -> tuple[dict | None, str | None]:
+    """(question, None) if it can be served, after repairs; (None, reason) if not."""
+    if not isinstance(question, dict):
+        return None, "schema"
+    question = _repair(question)
+    # The TypedDict drops unknown keys, which would serve an "E" option's question without it
+    options = question.get("options")
+    if isinstance(options, dict) and set(options) != set(LETTERS):
+        return None, "bad_options"
+    try:
+        question = QUESTION.validate_python(question)
+    except ValidationError as e:
+        error = e.errors()[0]
+        if error["loc"] and error["loc"][0] == "correct_answer":
+            return None, "bad_answer"
+        return None, "missing_field" if error["type"] == "missing" else "schema"
+
+    texts = [question["question"].strip(), *(text.strip() for text in question["options"].values())]
+    if len(texts[0]) < MIN_QUESTION_CHARS or not all(texts[1:]):
+        return None, "empty_text"
+    normalized = {re.sub(r"\s+", " ", text.lower()) for text in texts[1:]}
+    if len(normalized) < len(LETTERS):
+        return None, "duplicate_options"
+    return question, None
+
+def validate_questions(subject: str, questions: list) -> list[dict]:
+    """The servable questions, repaired where possible; the rest are counted by reason and dropped."""
+    valid = []
+    for question in questions:
+        question, reason = check_question(question)
+        if reason:
+            INVALID_QUESTIONS.labels(subject, reason).inc()
+        else:
+            valid.append(question)
+    return valid
@@ -0,0 +1,624 @@
+import os
+import abc
+import time
+import random
+import asyncio
+import sqlite3
+import hashlib
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from agents.metrics import SHARED_STATE_ERRORS
+
+# Where state that must agree across workers and instances lives:
+#   memory://                 this process only (single worker, the default)
+#   sqlite:///path.sqlite3    every worker on one host
+#   redis://host:6379/0       every worker on every host
+SHARED_STATE_URL = os.getenv("SHARED_STATE_URL", "memory://")
+# Redis connections kept per worker; each command or transaction holds one
+REDIS_POOL_SIZE = int(os.getenv("REDIS_POOL_SIZE", "8"))
+REDIS_TIMEOUT = float(os.getenv("REDIS_TIMEOUT", "0.5"))
+# Optimistic bucket updates retried this many times when other clients keep winning the race
+REDIS_TAKE_ATTEMPTS = 20
+
+def key_id(secret: str | None) -> str:
+    """Stable short id for an API key or token, so the secret itself is never stored."""
+    if not secret:
+        return "server"
+    return hashlib.blake2b(secret.encode("utf-8"), digest_size=12).hexdigest()
+
+class SharedState(abc.ABC):
+    """
+    Small set of atomic operations on numeric keys, enough for counters,
+    version stamps, flags with a TTL and token buckets. Keys expire after
+    their ttl (seconds). Times are wall-clock so they mean the same thing
+    on every host.
+    """
+
+    @abc.abstractmethod
+    async def get(self, key: str) -> float | None:
+        """The key's value, or None if it is absent or expired."""
+
+    @abc.abstractmethod
+    async def set(self, key: str, value: float, ttl: float | None = None, nx: bool = False) -> bool:
+        """Store value; with nx only if the key is absent. Returns whether it was stored."""
+
+    @abc.abstractmethod
+    async def incr(self, key: str, amount: int = 1, ttl: float | None = None) -> int:
+        """Add to a counter, creating it at 0; ttl is set when the key is created."""
+
+    @abc.abstractmethod
+    async def delete(self, *keys: str):
+        """Remove keys; absent ones are ignored."""
+
+    @abc.abstractmethod
+    async def take(self, key: str, rate: float, burst: float, cost: float) -> float:
+        """
+        Take cost tokens from a bucket refilling at rate per second up to
+        burst; returns 0 on success, otherwise the seconds until they would
+        be available. A negative cost puts tokens back.
+        """
+
+def _bucket_take(tokens: float | None, updated: float, now: float, rate: float, burst: float, cost: float) -> tuple[float, float]:
+    """(tokens left, wait) for one take; shared by every backend so they limit identically."""
+    tokens = burst if tokens is None else min(burst, tokens + (now - updated) * rate)
+    if cost < 0:
+        return min(burst, tokens - cost), 0.0
+    # A request larger than the burst can still go through once the bucket is full
+    cost = min(cost, burst)
+    if tokens >= cost:
+        return tokens - cost, 0.0
+    return tokens, (cost - tokens) / rate
+
+def _bucket_ttl(rate: float, burst: float) -> float:
+    """A bucket idle this long is full again, so forgetting it changes nothing."""
+    return burst / rate + 1
+
+class MemoryState(SharedState):
+    """Process-local state; what every worker had before, as a dict with expiry."""
+
+    def __init__(self, max_keys: int = 200_000):
+        self.max_keys = max_keys
+        self._data: dict[str, tuple[float, float, float]] = {}  # key -> (value, stamp, expires_at)
+
+    def _live(self, key: str, now: float) -> tuple[float, float, float] | None:
+        entry = self._data.get(key)
+        if entry is not None and entry[2] <= now:
+            del self._data[key]
+            return None
+        return entry
+
+    def _put(self, key: str, value: float, stamp: float, ttl: float | None):
+        if len(self._data) >= self.max_keys and key not in self._data:
+            now = time.time()
+            for stale in [k for k, entry in self._data.items() if entry[2] <= now]:
+                del self._data[stale]
+            if len(self._data) >= self.max_keys:
+                # Dicts keep insertion order, so this drops the oldest key
+                del self._data[next(iter(self._data))]
+        self._data[key] = (value, stamp, time.time() + ttl if ttl else float("inf"))
+
+    async def get(self, key: str) -> float | None:
+        entry = self._live(key, time.time())
+        return entry[0] if entry else None
+
+    async def set(self, key: str, value: float, ttl: float | None = None, nx: bool = False) -> bool:
+        if nx and self._live(key, time.time()):
+            return False
+        self._put(key, value, 0.0, ttl)
+        return True
+
+    async def incr(self, key: str, amount: int = 1, ttl: float | None = None) -> int:
+        entry = self._live(key, time.time())
+        if entry is None:
+            self._put(key, amount, 0.0, ttl)
+            return amount
+        value = int(entry[0]) + amount
+        self._data[key] = (value, entry[1], entry[2])
+        return value
+
+    async def delete(self, *keys: str):
+        for key in keys:
+            self._data.pop(key, None)
+
+    async def take(self, key: str, rate: float, burst: float, cost: float) -> float:
+        now = time.time()
+        entry = self._live(key, now)
+        tokens, wait = _bucket_take(entry[0] if entry else None, entry[1] if entry else now, now, rate, burst, cost)
+        self._put(key, tokens, now, _bucket_ttl(rate, burst))
+        return wait
+
+class SQLiteState(SharedState):
+    """
+    State in a WAL-mode SQLite file, shared by every process on the host.
+    Each operation is one short transaction; BEGIN IMMEDIATE makes the
+    read-modify-write of counters and buckets atomic across processes.
+    Operations run on one thread that owns the connection, so they are
+    serialised without a lock and waiting on a busy file never blocks the
+    event loop.
+    """
+
+    def __init__(self, path: str):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shared-state")
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=5, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS state (
+                key TEXT PRIMARY KEY,
+                value REAL NOT NULL,
+                stamp REAL NOT NULL,
+                expires_at REAL NOT NULL
+            ) WITHOUT ROWID
+            """
+        )
+        self._writes = 0
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _transaction(self, work):
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = work(time.time())
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._writes += 1
+        if self._writes % 1000 == 0:
+            self._conn.execute("DELETE FROM state WHERE expires_at <= ?", (time.time(),))
+        return result
+
+    def _row(self, key: str, now: float) -> tuple[float, float] | None:
+        return self._conn.execute(
+            "SELECT value, stamp FROM state WHERE key = ? AND expires_at > ?", (key, now)
+        ).fetchone()
+
+    def _put(self, key: str, value: float, stamp: float, expires_at: float):
+        self._conn.execute(
+            "INSERT INTO state VALUES (?, ?, ?, ?) ON CONFLICT(key) DO UPDATE SET "
+            "value = excluded.value, stamp = excluded.stamp, expires_at = excluded.expires_at",
+            (key, value, stamp, expires_at),
+        )
+
+    async def get(self, key: str) -> float | None:
+        row = await self._run(self._row, key, time.time())
+        return row[0] if row else None
+
+    async def set(self, key: str, value: float, ttl: float | None = None, nx: bool = False) -> bool:
+        def work(now):
+            if nx and self._row(key, now):
+                return False
+            self._put(key, value, 0.0, now + ttl if ttl else float("inf"))
+            return True
+        return await self._run(self._transaction, work)
+
+    async def incr(self, key: str, amount: int = 1, ttl: float | None = None) -> int:
+        def work(now):
+            row = self._row(key, now)
+            if row is None:
+                self._put(key, amount, 0.0, now + ttl if ttl else float("inf"))
+                return amount
+            self._conn.execute("UPDATE state SET value = value + ? WHERE key = ?", (amount, key))
+            return int(row[0]) + amount
+        return await self._run(self._transaction, work)
+
+    async def delete(self, *keys: str):
+        await self._run(self._conn.executemany, "DELETE FROM state WHERE key = ?", [(key,) for key in keys])
+
+    async def take(self, key: str, rate: float, burst: float, cost: float) -> float:
+        def work(now):
+            row = self._row(key, now)
+            tokens, wait = _bucket_take(row[0] if row else None, row[1] if row else now, now, rate, burst, cost)
+            self._put(key, tokens, now, now + _bucket_ttl(rate, burst))
+            return wait
+        return await self._run(self._transaction, work)
+
+class RedisError(Exception):
+    pass
+
+def _encode(*args) -> bytes:
+    out = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        data = arg if isinstance(arg, bytes) else str(arg).encode()
+        out.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b"".join(out)
+
+async def _read_reply(reader: asyncio.StreamReader):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("Redis connection closed")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest.decode()
+    if kind == b"-":
+        raise RedisError(rest.decode())
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        length = int(rest)
+        if length < 0:
+            return None
+        data = await reader.readexactly(length + 2)
+        return data[:-2]
+    if kind == b"*":
+        length = int(rest)
+        if length < 0:
+            return None
+        return [await _read_reply(reader) for _ in range(length)]
+    raise RedisError(f"Unexpected reply: {line!r}")
+
+class RedisState(SharedState):
+    """
+    State in Redis (or anything speaking RESP), shared by every instance.
+    A minimal asyncio client with a small connection pool; no redis-py
+    dependency. Buckets are updated with WATCH/MULTI/EXEC and retried on
+    conflict, so no server-side scripting is needed.
+    """
+
+    def __init__(self, url: str, pool_size: int = REDIS_POOL_SIZE, timeout: float = REDIS_TIMEOUT):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.db = int(parsed.path.strip("/") or 0)
+        self.password = parsed.password
+        self.timeout = timeout
+        self._idle: list[tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+        self._slots: asyncio.Semaphore | None = None
+        self._pool_size = pool_size
+
+    async def _connect(self):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        for command in ([("AUTH", self.password)] if self.password else []) + ([("SELECT", self.db)] if self.db else []):
+            writer.write(_encode(*command))
+            await _read_reply(reader)
+        return reader, writer
+
+    async def _acquire(self):
+        if self._slots is None:
+            # Created lazily so it binds to the running event loop
+            self._slots = asyncio.Semaphore(self._pool_size)
+        await self._slots.acquire()
+        try:
+            return self._idle.pop() if self._idle else await self._connect()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _release(self, conn, healthy: bool):
+        if healthy:
+            self._idle.append(conn)
+        else:
+            conn[1].close()
+        self._slots.release()
+
+    async def _call(self, conn, *args):
+        return (await self._pipeline(conn, args))[0]
+
+    async def _pipeline(self, conn, *commands):
+        """Send several commands in one write and read all their replies: one round trip."""
+        reader, writer = conn
+        writer.write(b"".join(_encode(*args) for args in commands))
+        replies = []
+        for _ in commands:
+            try:
+                replies.append(await asyncio.wait_for(_read_reply(reader), self.timeout))
+            except RedisError as e:
+                replies.append(e)
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    async def execute(self, *args):
+        conn = await self._acquire()
+        healthy = False
+        try:
+            reply = await self._call(conn, *args)
+            healthy = True
+            return reply
+        except RedisError:
+            healthy = True
+            raise
+        finally:
+            self._release(conn, healthy)
+
+    async def get(self, key: str) -> float | None:
+        value = await self.execute("GET", key)
+        return float(value) if value is not None else None
+
+    async def set(self, key: str, value: float, ttl: float | None = None, nx: bool = False) -> bool:
+        args = ["SET", key, repr(float(value))]
+        if ttl:
+            args += ["PX", max(1, int(ttl * 1000))]
+        if nx:
+            args.append("NX")
+        return await self.execute(*args) is not None
+
+    async def incr(self, key: str, amount: int = 1, ttl: float | None = None) -> int:
+        value = await self.execute("INCRBY", key, amount)
+        if ttl and value == amount:
+            await self.execute("PEXPIRE", key, max(1, int(ttl * 1000)))
+        return value
+
+    async def delete(self, *keys: str):
+        if keys:
+            await self.execute("DEL", *keys)
+
+    async def take(self, key: str, rate: float, burst: float, cost: float) -> float:
+        conn = await self._acquire()
+        healthy = False
+        try:
+            for attempt in range(REDIS_TAKE_ATTEMPTS):
+                _, raw = await self._pipeline(conn, ("WATCH", key), ("GET", key))
+                now = time.time()
+                tokens, updated = map(float, raw.split(b":")) if raw else (None, now)
+                tokens, wait = _bucket_take(tokens, updated, now, rate, burst, cost)
+                ttl = int(_bucket_ttl(rate, burst) * 1000)
+                *_, done = await self._pipeline(
+                    conn, ("MULTI",), ("SET", key, f"{tokens!r}:{now!r}", "PX", ttl), ("EXEC",)
+                )
+                if done is not None:
+                    healthy = True
+                    return wait
+                # Another client changed the bucket in between; back off with jitter so retries spread out
+                await asyncio.sleep(random.uniform(0, 0.0005 * 2 ** min(attempt, 6)))
+            healthy = True
+        finally:
+            self._release(conn, healthy)
+        # Still contended: deny briefly rather than grant without having counted it
+        return 1 / rate if cost > 0 else 0.0
+
+# What a backend raises when it is down or locked up, as opposed to a bug.
+# EOFError covers asyncio.IncompleteReadError: the server closed mid-reply.
+STATE_ERRORS = (OSError, EOFError, asyncio.TimeoutError, RedisError, sqlite3.OperationalError)
+
+class FailOpen(SharedState):
+    """
+    Wraps a backend so an outage degrades instead of failing requests: reads
+    miss, writes are dropped and buckets grant. Rate limits and breakers go
+    quiet and caches reload from SQLite until the backend is back.
+    """
+
+    def __init__(self, state: SharedState):
+        self.state = state
+        self._last_report = 0.0
+
+    def _failed(self, operation: str, error: Exception):
+        SHARED_STATE_ERRORS.labels(operation).inc()
+        if time.monotonic() - self._last_report > 60:
+            self._last_report = time.monotonic()
+            print(f"Shared state {operation} failed ({error!r}), continuing without it")
+
+    async def get(self, key: str) -> float | None:
+        try:
+            return await self.state.get(key)
+        except STATE_ERRORS as e:
+            self._failed("get", e)
+            return None
+
+    async def set(self, key: str, value: float, ttl: float | None = None, nx: bool = False) -> bool:
+        try:
+            return await self.state.set(key, value, ttl, nx)
+        except STATE_ERRORS as e:
+            self._failed("set", e)
+            return False
+
+    async def incr(self, key: str, amount: int = 1, ttl: float | None = None) -> int:
+        try:
+            return await self.state.incr(key, amount, ttl)
+        except STATE_ERRORS as e:
+            self._failed("incr", e)
+            return 0
+
+    async def delete(self, *keys: str):
+        try:
+            await self.state.delete(*keys)
+        except STATE_ERRORS as e:
+            self._failed("delete", e)
+
+    async def take(self, key: str, rate: float, burst: float, cost: float) -> float:
+        try:
+            return await self.state.take(key, rate, burst, cost)
+        except STATE_ERRORS as e:
+            self._failed("take", e)
+            return 0.0
+
+def open_state(url: str = SHARED_STATE_URL) -> SharedState:
+    scheme = urlparse(url).scheme
+    if scheme == "memory":
+        return MemoryState()
+    if scheme == "sqlite":
+        return FailOpen(SQLiteState(url[len("sqlite:///"):]))
+    if scheme == "redis":
+        return FailOpen(RedisState(url))
+    raise ValueError(f"Unsupported SHARED_STATE_URL: {url}")
+
+shared_state = open_state()
+
+class RedisStandIn:
+    """
+    In-process server for the subset of Redis that RedisState uses (strings,
+    expiry, INCRBY, WATCH/MULTI/EXEC), for testing and local multi-worker runs
+    without a Redis install.
+    """
+
+    def __init__(self):
+        self.data: dict[bytes, tuple[bytes, float]] = {}  # key -> (value, expires_at)
+        self.versions: dict[bytes, int] = {}
+        self.server: asyncio.AbstractServer | None = None
+
+    def _get(self, key: bytes) -> bytes | None:
+        entry = self.data.get(key)
+        if entry and entry[1] <= time.time():
+            del self.data[key]
+            entry = None
+        return entry[0] if entry else None
+
+    def _set(self, key: bytes, value: bytes, expires_at: float = float("inf")):
+        self.data[key] = (value, expires_at)
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def run(self, args: list[bytes]):
+        command = args[0].upper()
+        if command in (b"PING", b"SELECT", b"AUTH"):
+            return "PONG" if command == b"PING" else "OK"
+        if command == b"GET":
+            return self._get(args[1])
+        if command == b"SET":
+            key, value, options = args[1], args[2], [a.upper() for a in args[3:]]
+            if b"NX" in options and self._get(key) is not None:
+                return None
+            expires_at = float("inf")
+            if b"PX" in options:
+                expires_at = time.time() + int(args[3 + options.index(b"PX") + 1]) / 1000
+            self._set(key, value, expires_at)
+            return "OK"
+        if command == b"INCRBY":
+            key = args[1]
+            value = int(self._get(key) or 0) + int(args[2])
+            expires_at = self.data[key][1] if key in self.data else float("inf")
+            self._set(key, str(value).encode(), expires_at)
+            return value
+        if command == b"PEXPIRE":
+            if self._get(args[1]) is None:
+                return 0
+            self.data[args[1]] = (self.data[args[1]][0], time.time() + int(args[2]) / 1000)
+            return 1
+        if command == b"DEL":
+            removed = 0
+            for key in args[1:]:
+                if self._get(key) is not None:
+                    del self.data[key]
+                    self.versions[key] = self.versions.get(key, 0) + 1
+                    removed += 1
+            return removed
+        if command == b"FLUSHDB":
+            self.data.clear()
+            return "OK"
+        raise RedisError(f"ERR unknown command '{command.decode()}'")
+
+    @staticmethod
+    def _reply(value) -> bytes:
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, RedisError):
+            return b"-%s\r\n" % str(value).encode()
+        if isinstance(value, str):
+            return b"+%s\r\n" % value.encode()
+        if isinstance(value, int):
+            return b":%d\r\n" % value
+        if isinstance(value, list):
+            return b"*%d\r\n" % len(value) + b"".join(RedisStandIn._reply(v) for v in value)
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        watched: dict[bytes, int] = {}
+        queued: list[list[bytes]] | None = None
+        try:
+            while True:
+                args = await _read_reply(reader)
+                command = args[0].upper()
+                if command == b"WATCH":
+                    watched.update({key: self.versions.get(key, 0) for key in args[1:]})
+                    reply = "OK"
+                elif command == b"MULTI":
+                    queued, reply = [], "OK"
+                elif command == b"EXEC":
+                    # One event loop runs every client, so EXEC is atomic by construction
+                    if any(self.versions.get(key, 0) != version for key, version in watched.items()):
+                        reply = None
+                    else:
+                        reply = []
+                        for queued_args in queued or []:
+                            try:
+                                reply.append(self.run(queued_args))
+                            except RedisError as e:
+                                reply.append(e)
+                    queued, watched = None, {}
+                elif queued is not None:
+                    queued.append(args)
+                    reply = "QUEUED"
+                else:
+                    try:
+                        reply = self.run(args)
+                    except RedisError as e:
+                        reply = e
+                writer.write(self._reply(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        self.server = await asyncio.start_server(self._handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+def _serve_stand_in(port: int, ready: "multiprocessing.synchronize.Event"):
+    async def serve():
+        await RedisStandIn().start(port=port)
+        ready.set()
+        await asyncio.Event().wait()
+    asyncio.run(serve())
+
+def _bench_worker(url: str, takes: int, results: "multiprocessing.Queue"):
+    """One process taking single tokens from the shared bucket as fast as it can."""
+    async def run():
+        state = open_state(url)
+        granted = 0
+        for _ in range(takes):
+            granted += await state.take("bench:bucket", 1e-9, 1000, 1) == 0
+        results.put(granted)
+    asyncio.run(run())
+
+def _bench(processes: int = 4, takes: int = 500, ops: int = 2000):
+    """
+    Per-operation latency of each backend, then the point of sharing: four
+    processes drawing from one 1000-token bucket must get exactly 1000 tokens
+    between them, not 1000 each as with per-process state.
+    """
+    path = "/tmp/shared_state_bench.sqlite3"
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    port = random.randint(20000, 40000)
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=_serve_stand_in, args=(port, ready), daemon=True)
+    server.start()
+    ready.wait(10)
+
+    backends = {"memory": "memory://", "sqlite": f"sqlite:///{path}", "redis": f"redis://127.0.0.1:{port}/0"}
+
+    async def latency(url: str) -> tuple[float, float]:
+        state = open_state(url)
+        started = time.perf_counter()
+        for i in range(ops):
+            await state.take(f"bench:latency:{i % 50}", 100, 100, 1)
+        take = (time.perf_counter() - started) / ops
+        started = time.perf_counter()
+        for i in range(ops):
+            await state.get(f"bench:version:{i % 50}")
+        return take, (time.perf_counter() - started) / ops
+
+    for name, url in backends.items():
+        take, get = asyncio.run(latency(url))
+        granted = "n/a"
+        if name != "memory":
+            results = multiprocessing.Queue()
+            workers = [
+                multiprocessing.Process(target=_bench_worker, args=(url, takes, results)) for _ in range(processes)
+            ]
+            for worker in workers:
+                worker.start()
+            granted = sum(results.get() for _ in workers)
+            for worker in workers:
+                worker.join()
+        print(f"{name:7} take {take * 1e6:6.0f} us, get {get * 1e6:6.0f} us, "
+              f"{processes} processes x {takes} takes from a 1000-token bucket granted {granted}")
+    server.terminate()
+
+if __name__ == "__main__" and os.getenv("ENV") == "local":
+    _bench()
@@ -1,5 +1,6 @@
 import os
 from agents.mcq_agent import generate_questions as base_generate
+from agents.registry import SubjectSpec, register_subject
 
 SQL_INSTRUCTION = """
 You are an expert in MySQL and SQL programming.
@@ -20,6 +21,13 @@ Generate questions ONLY about MySQL:
 Do NOT include questions about Python, Java, or other programming languages. Use small SQL code snippets when useful.
 """
 
+register_subject(SubjectSpec(
+    id="sql",
+    name="SQL",
+    instruction=SQL_INSTRUCTION,
+    aliases=("dbms",),
+))
+
 async def generate_sql_questions(
     difficulty: str,
     num_questions: int,
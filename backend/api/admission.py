@@ -0,0 +1,194 @@
+import os
+import math
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from agents.metrics import ADMISSIONS, record_span
+from agents.shared_state import SharedState, key_id, shared_state
+
+# Token buckets are denominated in questions: a 40-question request costs 40 tokens
+RATE_LIMIT_IP_PER_MINUTE = float(os.getenv("RATE_LIMIT_IP_PER_MINUTE", "200"))
+RATE_LIMIT_IP_BURST = float(os.getenv("RATE_LIMIT_IP_BURST", "80"))
+RATE_LIMIT_KEY_PER_MINUTE = float(os.getenv("RATE_LIMIT_KEY_PER_MINUTE", "400"))
+RATE_LIMIT_KEY_BURST = float(os.getenv("RATE_LIMIT_KEY_BURST", "160"))
+# Generations running at once per worker, and how many more may wait for a slot
+ADMISSION_CONCURRENCY = int(os.getenv("ADMISSION_CONCURRENCY", "16"))
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "32"))
+# Waiting longer than this means the request would be too slow to be useful; fail it fast instead
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "10"))
+# Proxies in front of the app that append to X-Forwarded-For. Clients can
+# send the header themselves, so only the entries added by these proxies are
+# trusted; 0 ignores the header. Render (which sets RENDER) has one, and
+# there every socket peer is the proxy, so ignoring it would put all users
+# in one per-IP bucket
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "1" if os.getenv("RENDER") else "0"))
+
+class Overloaded(Exception):
+    """Request rejected by admission control; retry_after is in seconds."""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+class RateLimiter:
+    """
+    Token bucket per client key in shared state, so every worker and instance
+    draws from one budget instead of each granting the full rate.
+    """
+
+    def __init__(self, name: str, per_minute: float, burst: float, state: SharedState = shared_state):
+        self.name = name
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.state = state
+
+    async def take(self, key: str, cost: float) -> float:
+        """Take cost tokens; returns 0 on success, otherwise the seconds until they would be available."""
+        return await self.state.take(f"rate:{self.name}:{key}", self.rate, self.burst, cost)
+
+    async def refund(self, key: str, cost: float):
+        await self.state.take(f"rate:{self.name}:{key}", self.rate, self.burst, -min(cost, self.burst))
+
+class ConcurrencyGate:
+    """
+    At most `limit` requests run at once; up to `queue_size` more wait in FIFO
+    order for at most `timeout` seconds. Anything beyond that is rejected at
+    once, so admitted requests keep a predictable latency under overload
+    instead of everyone slowing down together.
+    """
+
+    def __init__(self, limit: int, queue_size: int, timeout: float):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(limit)
+        # Smoothed time a request holds its slot, used to estimate Retry-After
+        self._service_time = 5.0
+
+    def retry_after(self) -> float:
+        """Rough time until a newly queued request would get a slot."""
+        return self._service_time * (self.waiting + 1) / self.limit
+
+    def check(self):
+        """Fail fast if a request arriving now would be rejected for a full queue."""
+        if self._semaphore.locked() and self.waiting >= self.queue_size:
+            raise Overloaded("queue_full", self.retry_after())
+
+    @asynccontextmanager
+    async def slot(self):
+        if self._semaphore.locked():
+            self.check()
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), self.timeout)
+            except asyncio.TimeoutError:
+                raise Overloaded("queue_timeout", self.retry_after())
+            finally:
+                self.waiting -= 1
+        else:
+            await self._semaphore.acquire()
+
+        self.active += 1
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+            self._service_time += 0.1 * (time.monotonic() - started - self._service_time)
+
+def client_ip(headers, client_host: str | None, hops: int = TRUSTED_PROXY_HOPS) -> str:
+    """
+    The address the outermost trusted proxy saw: the hops-th X-Forwarded-For
+    entry from the right. Entries left of it were sent by the client.
+    """
+    if hops > 0:
+        entries = [entry.strip() for entry in headers.get("x-forwarded-for", "").split(",") if entry.strip()]
+        if entries:
+            return entries[-min(hops, len(entries))]
+    return client_host or "unknown"
+
+class AdmissionController:
+    """Per-IP and per-API-key token buckets weighted by question count, then the concurrency gate."""
+
+    def __init__(self):
+        self.ip_limiter = RateLimiter("ip", RATE_LIMIT_IP_PER_MINUTE, RATE_LIMIT_IP_BURST)
+        self.key_limiter = RateLimiter("key", RATE_LIMIT_KEY_PER_MINUTE, RATE_LIMIT_KEY_BURST)
+        self.gate = ConcurrencyGate(ADMISSION_CONCURRENCY, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT)
+
+    async def refund(self, charged: tuple[str, str], cost: int):
+        ip, key = charged
+        await self.ip_limiter.refund(ip, cost)
+        await self.key_limiter.refund(key, cost)
+
+    async def charge(self, ip: str, api_key: str | None, cost: int) -> tuple[str, str]:
+        """Charge both buckets or neither; raises Overloaded when either is empty."""
+        key = key_id(api_key)
+        try:
+            wait = await self.ip_limiter.take(ip, cost)
+            if wait:
+                raise Overloaded("rate_limited_ip", wait)
+            wait = await self.key_limiter.take(key, cost)
+            if wait:
+                await self.ip_limiter.refund(ip, cost)
+                raise Overloaded("rate_limited_key", wait)
+        except Overloaded as e:
+            ADMISSIONS.labels(e.reason).inc()
+            raise
+        return ip, key
+
+    @asynccontextmanager
+    async def admit(self, ip: str, api_key: str | None, cost: int, charged: tuple[str, str] | None = None):
+        """
+        Hold an admission for the duration of the block. Pass `charged` when
+        the buckets were already charged up front (see charge()).
+        """
+        charged = charged or await self.charge(ip, api_key, cost)
+        started = time.perf_counter()
+        try:
+            async with self.gate.slot():
+                record_span("admission", time.perf_counter() - started)
+                ADMISSIONS.labels("admitted").inc()
+                yield
+        except Overloaded as e:
+            # Rejected by the gate: nothing ran, so the request should not use up the client's budget
+            ADMISSIONS.labels(e.reason).inc()
+            await self.refund(charged, cost)
+            raise
+
+def retry_after_header(seconds: float) -> dict[str, str]:
+    return {"Retry-After": str(max(1, math.ceil(seconds)))}
+
+async def _bench(requests: int = 400, service_time: float = 0.05):
+    """
+    Offered load at 4x capacity: admitted requests should keep roughly their
+    unloaded latency, the excess should be rejected quickly.
+    """
+    gate = ConcurrencyGate(limit=8, queue_size=8, timeout=service_time * 4)
+    admitted, rejected = [], []
+
+    async def request():
+        started = time.perf_counter()
+        try:
+            async with gate.slot():
+                await asyncio.sleep(service_time)
+            admitted.append(time.perf_counter() - started)
+        except Overloaded:
+            rejected.append(time.perf_counter() - started)
+
+    capacity = gate.limit / service_time
+    tasks = []
+    for _ in range(requests):
+        tasks.append(asyncio.create_task(request()))
+        await asyncio.sleep(1 / (capacity * 4))
+    await asyncio.gather(*tasks)
+    admitted.sort()
+    print(f"{len(admitted)} admitted: p50 {admitted[len(admitted) // 2] * 1000:.0f} ms, "
+          f"p99 {admitted[int(len(admitted) * 0.99)] * 1000:.0f} ms (service {service_time * 1000:.0f} ms)")
+    print(f"{len(rejected)} rejected: max {max(rejected, default=0) * 1000:.1f} ms to 429")
+
+if __name__ == "__main__" and os.getenv("ENV") == "local":
+    asyncio.run(_bench())
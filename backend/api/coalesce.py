@@ -0,0 +1,111 @@
+import os
+import re
+import asyncio
+import random
+from typing import Any, Awaitable, Callable, Hashable
+
+class SingleFlight:
+    """
+    Merges identical concurrent calls: the first caller for a key runs the
+    call, everyone arriving while it is in flight awaits the same result.
+    If the shared call fails, each follower retries with its own call, so one
+    caller's bad key or cancelled request does not fail the others.
+    """
+
+    def __init__(self):
+        self._inflight: dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, call: Callable[[], Awaitable[Any]]) -> tuple[Any, bool]:
+        """Returns (result, shared), where shared is True if the result came from another caller's call."""
+        future = self._inflight.get(key)
+        if future is not None:
+            try:
+                return await asyncio.shield(future), True
+            except Exception:
+                return await call(), False
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await call()
+            future.set_result(result)
+            return result, False
+        except BaseException as e:
+            future.set_exception(e if isinstance(e, Exception) else RuntimeError("Shared call was cancelled"))
+            # Mark retrieved so a call without followers does not log an unhandled exception
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+# Options or explanations that point at other options by letter or position
+# ("All of the above", "Both A and C", "Option B is correct") stop making
+# sense once the options move
+_POSITIONAL = re.compile(
+    r"(?i:\b(?:above|below)\b|\b(?:all|none|both|neither) of (?:these|them)\b)"
+    r"|(?i:\b(?:options?|answers?|choices?)\b)\s*[:-]?\s*\(?[A-D]\b"
+    r"|\b[A-D]\s*(?:,|&|\band\b|\bor\b)\s*[A-D]\b"
+    r"|\(\s*[A-D]\s*\)|\b[A-D]\)"
+    r"|\b[A-D]\s+is\s+(?i:correct|incorrect|wrong|right|true|false)\b"
+)
+
+# Any capital A-D standing alone in an explanation is taken as an option
+# letter ("The correct answer is B because..."), except "A" opening a
+# sentence as an article ("A stack is LIFO.")
+_LETTER = re.compile(r"\b[A-D]\b")
+_ARTICLE = re.compile(r"(?:^|[.!?:\n]\s*)A\s+[a-z]")
+
+def _names_letter(explanation: str) -> bool:
+    for match in _LETTER.finditer(explanation):
+        if match.group() != "A":
+            return True
+        sentence_start = explanation[:match.start()].rstrip()
+        if not _ARTICLE.match(explanation, len(sentence_start) - 1 if sentence_start else 0):
+            return True
+    return False
+
+def refers_to_positions(question: dict) -> bool:
+    """True if an option or the explanation mentions an option letter or "above"/"below"."""
+    explanation = question.get("explanation")
+    if isinstance(explanation, str) and _names_letter(explanation):
+        return True
+    texts = [*question["options"].values(), explanation]
+    return any(isinstance(text, str) and _POSITIONAL.search(text) for text in texts)
+
+def shuffle_questions(questions: list[dict]) -> list[dict]:
+    """
+    Copy of questions in random order with option letters reassigned, so
+    shared results look distinct. Questions whose options or explanation
+    refer to letters or positions keep their options as they are.
+    """
+    shuffled = []
+    for question in random.sample(questions, len(questions)):
+        options = question.get("options")
+        if (
+            not isinstance(options, dict)
+            or question.get("correct_answer") not in options
+            or refers_to_positions(question)
+        ):
+            shuffled.append(dict(question))
+            continue
+        letters = list(options)
+        texts = random.sample(list(options.items()), len(letters))
+        new_options = {letter: text for letter, (_, text) in zip(letters, texts)}
+        correct = next(letter for letter, (old, _) in zip(letters, texts) if old == question["correct_answer"])
+        shuffled.append({**question, "options": new_options, "correct_answer": correct})
+    return shuffled
+
+def _check():
+    """Explanations naming a letter keep their answer key through shuffling; plain ones still get shuffled."""
+    options = {"A": "O(1)", "B": "O(log n)", "C": "O(n)", "D": "O(n log n)"}
+    named = {"options": options, "correct_answer": "B", "explanation": "The correct answer is B because the range halves."}
+    plain = {"options": options, "correct_answer": "B", "explanation": "A balanced search halves the range each step."}
+    for _ in range(200):
+        kept = shuffle_questions([named])[0]
+        assert kept["options"] == options and kept["correct_answer"] == "B", kept
+    moved = {tuple(shuffle_questions([plain])[0]["options"].values()) for _ in range(200)}
+    assert len(moved) > 1, "plain questions were not shuffled"
+    print("shuffle_questions: letter references kept, plain questions shuffled")
+
+if __name__ == "__main__" and os.getenv("ENV") == "local":
+    _check()
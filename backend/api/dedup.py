@@ -0,0 +1,238 @@
+import os
+import re
+import time
+import zlib
+import random
+import sqlite3
+import hashlib
+import operator
+import threading
+from array import array
+
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "1") == "1"
+DEDUP_PATH = os.getenv("DEDUP_PATH", "question_history.sqlite3")
+# Estimated Jaccard similarity (over character shingles) from which two questions count as duplicates
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.7"))
+DEDUP_HISTORY_TTL = int(os.getenv("DEDUP_HISTORY_TTL", str(30 * 24 * 3600)))
+DEDUP_HISTORY_MAX_ROWS = int(os.getenv("DEDUP_HISTORY_MAX_ROWS", "500000"))
+# Extra LLM calls allowed per request to replace dropped duplicates
+DEDUP_TOP_UP_ATTEMPTS = int(os.getenv("DEDUP_TOP_UP_ATTEMPTS", "1"))
+
+SHINGLE = 5
+# Stock phrases ("what is the output of the following code") make some band
+# buckets very common; only the newest entries of a bucket are compared
+BUCKET_SCAN = 16
+# One-permutation MinHash: each shingle hash lands in one of BINS bins, which
+# are grouped into BANDS bands for LSH. Pairs at similarity 0.7 share a band
+# with ~90% probability, pairs at 0.3 with ~6%.
+BINS = 32
+BANDS = 8
+ROWS = BINS // BANDS
+_EMPTY = 0xFFFFFFFF
+_MIX = 0x9E3779B97F4A7C15
+_MASK = (1 << 64) - 1
+
+def normalize(question: dict) -> str:
+    """Lowercased question and option texts with punctuation and spacing collapsed."""
+    options = question.get("options")
+    texts = [str(question.get("question", ""))]
+    if isinstance(options, dict):
+        texts.extend(sorted(str(text) for text in options.values()))
+    return re.sub(r"[\W_]+", " ", " ".join(texts).lower()).strip()
+
+def signature(text: str) -> array:
+    """One-permutation MinHash of the text's character shingles, one 32-bit value per bin."""
+    raw = text.encode()
+    crc32 = zlib.crc32
+    hashes = sorted(
+        {(crc32(raw[i:i + SHINGLE]) * _MIX) & _MASK for i in range(max(1, len(raw) - SHINGLE + 1))},
+        reverse=True,
+    )
+    # Written largest first, so each bin ends up holding its smallest hash
+    mins = {h % BINS: h >> 32 for h in hashes}
+    return array("I", [mins.get(b, _EMPTY) for b in range(BINS)])
+
+def similarity(a: array, b: array) -> float:
+    """Jaccard estimate: share of bins holding the same minimum."""
+    return sum(map(operator.eq, a, b)) / BINS
+
+def band_keys(subject: str, sig: array) -> list[int]:
+    """One signed 64-bit LSH key per band, scoped to the subject."""
+    raw = sig.tobytes()
+    step = ROWS * sig.itemsize
+    return [
+        int.from_bytes(
+            hashlib.blake2b(raw[i * step:(i + 1) * step], digest_size=8, person=f"{subject}:{i}".encode()[:16]).digest(),
+            "little",
+            signed=True,
+        )
+        for i in range(BANDS)
+    ]
+
+class DuplicateIndex:
+    """
+    Persistent history of served questions with an LSH index in SQLite, so a
+    lookup is one indexed query for the question's bands, however long the
+    history grows. Entries expire after ttl seconds; past max_rows the oldest
+    are evicted.
+    """
+
+    def __init__(
+        self,
+        path: str = DEDUP_PATH,
+        threshold: float = DEDUP_THRESHOLD,
+        ttl: int = DEDUP_HISTORY_TTL,
+        max_rows: int = DEDUP_HISTORY_MAX_ROWS,
+    ):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # Every request writes its new questions; WAL keeps those commits off the fsync path
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY,
+                subject TEXT NOT NULL,
+                signature BLOB NOT NULL,
+                created_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS bands (
+                key INTEGER NOT NULL,
+                id INTEGER NOT NULL,
+                PRIMARY KEY (key, id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS bands_id ON bands (id);
+            CREATE INDEX IF NOT EXISTS history_created ON history (created_at);
+            """
+        )
+        self._conn.commit()
+        self._rows = self._conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+
+    def _seen(self, keys: list[int], sig: array) -> bool:
+        since = time.time() - self.ttl
+        checked = set()
+        for key in keys:
+            rows = self._conn.execute(
+                "SELECT h.id, h.signature FROM bands b JOIN history h ON h.id = b.id "
+                "WHERE b.key = ? AND h.created_at > ? ORDER BY b.id DESC LIMIT ?",
+                (key, since, BUCKET_SCAN),
+            ).fetchall()
+            for id_, blob in rows:
+                if id_ in checked:
+                    continue
+                checked.add(id_)
+                if similarity(sig, array("I", blob)) >= self.threshold:
+                    return True
+        return False
+
+    def filter(
+        self,
+        subject: str,
+        questions: list[dict],
+        history: bool = True,
+        record: bool = True,
+        batch: list[dict] = (),
+    ) -> tuple[list[dict], list[dict]]:
+        """
+        Split questions into (unique, duplicates), checking each against the
+        ones before it, against batch (questions already in the same
+        response) and, if history, against the history. With record, unique
+        ones are added to the history, since they are about to be served.
+        """
+        unique, duplicates = [], []
+        earlier: dict[int, list[array]] = {}
+        texts = set()
+        for question in batch:
+            text = normalize(question)
+            sig = signature(text)
+            texts.add(text)
+            for key in band_keys(subject, sig):
+                earlier.setdefault(key, []).append(sig)
+        now = time.time()
+        with self._lock:
+            for question in questions:
+                text = normalize(question)
+                if text in texts:
+                    duplicates.append(question)
+                    continue
+                sig = signature(text)
+                keys = band_keys(subject, sig)
+                in_batch = any(
+                    similarity(sig, other) >= self.threshold for key in keys for other in earlier.get(key, ())
+                )
+                if in_batch or (history and self._seen(keys, sig)):
+                    duplicates.append(question)
+                    continue
+
+                texts.add(text)
+                for key in keys:
+                    earlier.setdefault(key, []).append(sig)
+                unique.append(question)
+                if not record:
+                    continue
+                cursor = self._conn.execute(
+                    "INSERT INTO history (subject, signature, created_at) VALUES (?, ?, ?)",
+                    (subject, sig.tobytes(), now),
+                )
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO bands VALUES (?, ?)", [(key, cursor.lastrowid) for key in keys]
+                )
+            if record:
+                self._conn.commit()
+                self._rows += len(unique)
+                if self._rows > self.max_rows:
+                    self._evict()
+        return unique, duplicates
+
+    def _evict(self):
+        """Drop expired entries, then the oldest ones until the history is back under 90% of max_rows."""
+        cutoff = self._conn.execute(
+            "SELECT created_at FROM history ORDER BY created_at DESC LIMIT 1 OFFSET ?",
+            (int(self.max_rows * 0.9),),
+        ).fetchone()
+        cutoff = max(cutoff[0] if cutoff else 0, time.time() - self.ttl)
+        self._conn.execute("DELETE FROM bands WHERE id IN (SELECT id FROM history WHERE created_at <= ?)", (cutoff,))
+        self._conn.execute("DELETE FROM history WHERE created_at <= ?", (cutoff,))
+        self._conn.commit()
+        self._rows = self._conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+
+# History of served questions, shared by the routes and the pre-generation scheduler
+duplicate_index = DuplicateIndex() if DEDUP_ENABLED else None
+
+def _bench(history_size: int = 200_000, probes: int = 2000):
+    """Lookup cost against a large history, plus how many near-duplicates are caught and distinct questions kept."""
+    from agents.fake_provider import FakeProvider
+    rng = random.Random(7)
+    fake = FakeProvider("bench", seed=7)
+    path = "/tmp/dedup_bench.sqlite3"
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    index = DuplicateIndex(path, max_rows=history_size * 2)
+    history = fake.questions(history_size, "java")
+    started = time.perf_counter()
+    for i in range(0, history_size, 1000):
+        index.filter("bench", history[i:i + 1000])
+    print(f"history of {history_size} built in {time.perf_counter() - started:.1f}s")
+
+    # Near-duplicates: same question with a changed word and different letter casing/punctuation
+    near = []
+    for question in rng.sample(history, probes):
+        text = question["question"].upper().replace("?", " ?!").split()
+        text[rng.randrange(len(text))] = "swapped"
+        near.append({"question": " ".join(text), "options": dict(question["options"])})
+    distinct = fake.questions(probes, "java")
+
+    started = time.perf_counter()
+    caught = sum(len(index.filter("bench", [q])[1]) for q in near)
+    kept = sum(len(index.filter("bench", [q])[0]) for q in distinct)
+    per_question = (time.perf_counter() - started) / (2 * probes)
+    print(f"check and record {per_question * 1e6:.0f} us/question, near-duplicates caught {caught / probes:.1%}, "
+          f"distinct kept {kept / probes:.1%}")
+
+if __name__ == "__main__" and os.getenv("ENV") == "local":
+    _bench()
@@ -0,0 +1,140 @@
+import os
+import random
+import asyncio
+from datetime import datetime
+from agents.parsing import parse_llm_response
+from agents.schema import validate_questions
+from agents.mcq_agent import generate_questions
+from agents.registry import SubjectSpec, all_subjects, load_subjects
+from agents.shared_state import SharedState, shared_state
+from api.question_bank import QuestionBank, bucket_changed, sync_bucket
+from api.dedup import duplicate_index
+
+PREGEN_ENABLED = os.getenv("PREGEN_ENABLED", "0") == "1"
+PREGEN_STOCK_PATH = os.getenv("PREGEN_STOCK_PATH", "question_stock.sqlite3")
+PREGEN_LOW_WATERMARK = int(os.getenv("PREGEN_LOW_WATERMARK", "50"))
+PREGEN_TARGET_STOCK = int(os.getenv("PREGEN_TARGET_STOCK", "200"))
+PREGEN_BATCH_SIZE = int(os.getenv("PREGEN_BATCH_SIZE", "10"))
+# Upstream calls per minute for the scheduler, shared by every worker and instance
+PREGEN_RPM = float(os.getenv("PREGEN_RPM", "6"))
+# How long a worker's claim on a bucket lasts without being renewed; renewed on every batch
+PREGEN_LEASE_TTL = float(os.getenv("PREGEN_LEASE_TTL", "600"))
+# Local hours in which refills run, "start-end" with end exclusive; may wrap midnight ("22-6")
+PREGEN_OFFPEAK_HOURS = os.getenv("PREGEN_OFFPEAK_HOURS", "0-7")
+PREGEN_CHECK_INTERVAL = int(os.getenv("PREGEN_CHECK_INTERVAL", "300"))
+PREGEN_MAX_ROWS = int(os.getenv("PREGEN_MAX_ROWS", "20000"))
+
+DIFFICULTIES = ("easy", "medium", "hard")
+
+# Pre-generated questions; each one is removed from stock once it is served
+stock = QuestionBank(PREGEN_STOCK_PATH, max_rows=PREGEN_MAX_ROWS)
+
+def in_offpeak(hour: int | None = None) -> bool:
+    start, end = (int(h) for h in PREGEN_OFFPEAK_HOURS.split("-"))
+    hour = datetime.now().hour if hour is None else hour
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+class RequestBudget:
+    """
+    Token bucket in shared state, so the scheduler stays under rpm requests
+    per minute in total however many workers and instances run it.
+    """
+
+    def __init__(self, rpm: float, state: SharedState = shared_state, key: str = "pregen:rpm"):
+        self.rate = rpm / 60
+        self.state = state
+        self.key = key
+
+    async def acquire(self):
+        while wait := await self.state.take(self.key, self.rate, 1, 1):
+            await asyncio.sleep(wait)
+
+class RefillLease:
+    """
+    One worker's claim on a bucket, so workers refill different buckets
+    instead of all generating for the same one. Expires after
+    PREGEN_LEASE_TTL if its holder dies without releasing it.
+    """
+
+    def __init__(self, subject: str, difficulty: str, state: SharedState = shared_state):
+        self.key = f"pregen:lease:{subject}:{difficulty}"
+        self.state = state
+        # Unique per claim, so only the holder can renew or release it
+        self.token = float(random.getrandbits(52) + 1)
+
+    async def acquire(self) -> bool:
+        return await self.state.set(self.key, self.token, ttl=PREGEN_LEASE_TTL, nx=True)
+
+    async def renew(self) -> bool:
+        """Extend the lease if this worker still holds it."""
+        if await self.state.get(self.key) != self.token:
+            return False
+        return await self.state.set(self.key, self.token, ttl=PREGEN_LEASE_TTL)
+
+    async def release(self):
+        if await self.state.get(self.key) == self.token:
+            await self.state.delete(self.key)
+
+async def refill(spec: SubjectSpec, difficulty: str, budget: RequestBudget) -> int:
+    """
+    Top one bucket up to PREGEN_TARGET_STOCK. Returns how many questions were
+    added; 0 without generating if another worker holds the bucket's lease.
+    """
+    lease = RefillLease(spec.id, difficulty)
+    if not await lease.acquire():
+        return 0
+    try:
+        return await _refill(spec, difficulty, budget, lease)
+    finally:
+        await lease.release()
+
+async def _refill(spec: SubjectSpec, difficulty: str, budget: RequestBudget, lease: RefillLease) -> int:
+    added = 0
+    while in_offpeak() and await lease.renew():
+        await sync_bucket(stock, spec.id, difficulty)
+        missing = PREGEN_TARGET_STOCK - await asyncio.to_thread(stock.count, spec.id, difficulty)
+        if missing <= 0:
+            break
+        await budget.acquire()
+        raw = await generate_questions(
+            subject=spec.name,
+            difficulty=difficulty,
+            num_questions=min(PREGEN_BATCH_SIZE, missing),
+            extra_instruction=spec.instruction,
+            model=spec.model,
+            # One upstream call per budget slot
+            shard_size=PREGEN_BATCH_SIZE,
+            topics=spec.topics,
+        )
+        questions = validate_questions(spec.id, parse_llm_response(raw).get("questions", []))
+        if duplicate_index is not None:
+            # Not served yet, so not recorded; take_cached records them when they are
+            questions, _ = await asyncio.to_thread(duplicate_index.filter, spec.id, questions, record=False)
+        new = await asyncio.to_thread(stock.add, spec.id, difficulty, questions, 0)
+        if not new:
+            break
+        await bucket_changed(stock, spec.id, difficulty)
+        added += new
+    return added
+
+async def run_pregen():
+    """Background loop that keeps every (subject, difficulty) bucket stocked during off-peak hours."""
+    load_subjects()
+    budget = RequestBudget(PREGEN_RPM)
+    while True:
+        if in_offpeak():
+            levels = []
+            for spec in all_subjects():
+                for difficulty in DIFFICULTIES:
+                    await sync_bucket(stock, spec.id, difficulty)
+                    level = await asyncio.to_thread(stock.count, spec.id, difficulty)
+                    if level < PREGEN_LOW_WATERMARK:
+                        levels.append((level, spec.id, difficulty, spec))
+            for _, subject, difficulty, spec in sorted(levels, key=lambda item: item[:3]):
+                try:
+                    await refill(spec, difficulty, budget)
+                except Exception as e:
+                    print(f"Pre-generation for {subject}/{difficulty} failed: {e}")
+        await asyncio.sleep(PREGEN_CHECK_INTERVAL)
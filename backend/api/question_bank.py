@@ -0,0 +1,318 @@
+import os
+import json
+import time
+import random
+import sqlite3
+import hashlib
+import threading
+import multiprocessing
+from collections import OrderedDict
+from agents.schema import LETTERS
+from agents.shared_state import shared_state
+
+QUESTION_BANK_PATH = os.getenv("QUESTION_BANK_PATH", "question_bank.sqlite3")
+QUESTION_BANK_TTL = int(os.getenv("QUESTION_BANK_TTL", str(7 * 24 * 3600)))
+QUESTION_BANK_MAX_ROWS = int(os.getenv("QUESTION_BANK_MAX_ROWS", "200000"))
+QUESTION_BANK_HOT_BUCKETS = int(os.getenv("QUESTION_BANK_HOT_BUCKETS", "24"))
+
+# Share of each request that is still generated fresh by the LLM; the rest comes from the bank
+QUESTION_BANK_FRESH_RATIO = float(os.getenv("QUESTION_BANK_FRESH_RATIO", "0.2"))
+
+def question_hash(question: dict) -> str:
+    """Stable content hash of a question (text and options), independent of its id."""
+    body = json.dumps([question.get("question"), question.get("options")], sort_keys=True)
+    return hashlib.sha1(body.encode("utf-8")).hexdigest()
+
+# Bits per offset packed into QuestionRecord.ends; a record's text is at most 16 MiB
+_OFFSET_BITS = 24
+_OFFSET_MASK = (1 << _OFFSET_BITS) - 1
+_ANSWERS = {letter: i for i, letter in enumerate(LETTERS)}
+
+class QuestionRecord:
+    """
+    One question in the hot tier, in about a third of the memory of the
+    parsed dict. The question, the four options and the explanation are one
+    UTF-8 bytes pool; their end offsets, in characters, are packed into a
+    single int. The answer is an index into LETTERS, and the content hash is
+    kept as its 20 raw bytes. Subject and difficulty are not stored per question at all,
+    since the hot tier is already keyed by them.
+    """
+
+    __slots__ = ("digest", "pool", "ends", "answer", "expires_at", "served")
+
+    def __init__(self, digest: bytes, pool: bytes, ends: int, answer: int, expires_at: float, served: int):
+        self.digest = digest
+        self.pool = pool
+        self.ends = ends
+        self.answer = answer
+        self.expires_at = expires_at
+        self.served = served
+
+    @classmethod
+    def from_question(cls, question: dict, expires_at: float, served: int, digest: str | None = None) -> "QuestionRecord | None":
+        """Record for a validated question; None for shapes that do not fit (legacy rows from before validation)."""
+        options = question.get("options")
+        answer = _ANSWERS.get(question.get("correct_answer"))
+        if answer is None or not isinstance(options, dict) or options.keys() != _ANSWERS.keys():
+            return None
+        parts = [question.get("question"), *(options[letter] for letter in LETTERS), question.get("explanation", "")]
+        if not all(isinstance(part, str) for part in parts):
+            return None
+        ends, end = 0, 0
+        for i, part in enumerate(parts[:-1]):
+            end += len(part)
+            ends |= end << (i * _OFFSET_BITS)
+        pool = "".join(parts).encode("utf-8")
+        if len(pool) > _OFFSET_MASK:
+            return None
+        return cls(bytes.fromhex(digest or question_hash(question)), pool, ends, answer, expires_at, served)
+
+    @property
+    def hash(self) -> str:
+        return self.digest.hex()
+
+    def to_question(self) -> dict:
+        """The question in the response shape (ids are assigned per response)."""
+        # One decode, then slicing by character offsets
+        pool, ends = self.pool.decode("utf-8"), self.ends
+        a = ends & _OFFSET_MASK
+        b = ends >> _OFFSET_BITS & _OFFSET_MASK
+        c = ends >> 2 * _OFFSET_BITS & _OFFSET_MASK
+        d = ends >> 3 * _OFFSET_BITS & _OFFSET_MASK
+        e = ends >> 4 * _OFFSET_BITS
+        return {
+            "id": 0,
+            "question": pool[:a],
+            "options": {"A": pool[a:b], "B": pool[b:c], "C": pool[c:d], "D": pool[d:e]},
+            "correct_answer": LETTERS[self.answer],
+            "explanation": pool[e:],
+        }
+
+class QuestionBank:
+    """
+    Questions per (subject, difficulty) persisted in SQLite, with the most
+    recently used buckets kept in memory so sampling does not touch the disk.
+    Entries expire after ttl seconds; once the table grows past max_rows the
+    oldest entries are evicted. Other workers writing the same file are picked
+    up through a version per bucket in shared state (see sync_bucket).
+    """
+
+    def __init__(
+        self,
+        path: str = QUESTION_BANK_PATH,
+        ttl: int = QUESTION_BANK_TTL,
+        max_rows: int = QUESTION_BANK_MAX_ROWS,
+        hot_buckets: int = QUESTION_BANK_HOT_BUCKETS,
+    ):
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.hot_buckets = hot_buckets
+        self._lock = threading.Lock()
+        self._hot: "OrderedDict[tuple[str, str], list[QuestionRecord]]" = OrderedDict()
+        # Shared version of each bucket the hot copy is known to be up to date with
+        self._versions: dict[tuple[str, str], int] = {}
+        self.name = os.path.basename(path)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # Requests write here on every serve; WAL lets workers sharing the file read while one writes
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS questions (
+                hash TEXT PRIMARY KEY,
+                subject TEXT NOT NULL,
+                difficulty TEXT NOT NULL,
+                body TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                expires_at REAL NOT NULL,
+                served INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS questions_bucket ON questions (subject, difficulty, expires_at)"
+        )
+        self._conn.commit()
+        self._rows = self._conn.execute("SELECT COUNT(*) FROM questions").fetchone()[0]
+
+    def _bucket(self, subject: str, difficulty: str) -> list[QuestionRecord]:
+        key = (subject, difficulty)
+        bucket = self._hot.get(key)
+        if bucket is not None:
+            self._hot.move_to_end(key)
+            return bucket
+
+        rows = self._conn.execute(
+            "SELECT hash, body, expires_at, served FROM questions "
+            "WHERE subject = ? AND difficulty = ? AND expires_at > ?",
+            (subject, difficulty, time.time()),
+        ).fetchall()
+        bucket = []
+        for h, body, expires_at, served in rows:
+            record = QuestionRecord.from_question(json.loads(body), expires_at, served, h)
+            if record is not None:
+                bucket.append(record)
+        self._hot[key] = bucket
+        while len(self._hot) > self.hot_buckets:
+            self._hot.popitem(last=False)
+        return bucket
+
+    def version_key(self, subject: str, difficulty: str) -> str:
+        return f"bank:{self.name}:{subject}:{difficulty}"
+
+    def refresh(self, subject: str, difficulty: str, version: int):
+        """Drop the hot copy of a bucket if another process changed it since it was loaded."""
+        key = (subject, difficulty)
+        with self._lock:
+            if key in self._hot and self._versions.get(key) != version:
+                del self._hot[key]
+            self._versions[key] = version
+
+    def changed(self, subject: str, difficulty: str, version: int):
+        """
+        Note this process's own change, already applied to the hot copy. If
+        another process changed the bucket in between, the hot copy stays
+        behind and the next refresh reloads it.
+        """
+        key = (subject, difficulty)
+        with self._lock:
+            if self._versions.get(key) == version - 1:
+                self._versions[key] = version
+
+    def add(self, subject: str, difficulty: str, questions: list[dict], served: int = 1) -> int:
+        """Store questions that are not in the bank yet. Returns how many were added."""
+        now = time.time()
+        added = []
+        with self._lock:
+            for question in questions:
+                record = QuestionRecord.from_question(question, now + self.ttl, served)
+                if record is None:
+                    continue
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO questions VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (record.hash, subject, difficulty, json.dumps(question), now, record.expires_at, served),
+                )
+                if cursor.rowcount:
+                    added.append(record)
+            self._conn.commit()
+            self._rows += len(added)
+
+            bucket = self._hot.get((subject, difficulty))
+            if bucket is not None:
+                bucket.extend(added)
+            if self._rows > self.max_rows:
+                self._evict()
+        return len(added)
+
+    def _evict(self):
+        """Drop expired rows, then the oldest ones until the table is back under 90% of max_rows."""
+        self._conn.execute("DELETE FROM questions WHERE expires_at <= ?", (time.time(),))
+        excess = self._conn.execute("SELECT COUNT(*) FROM questions").fetchone()[0] - int(self.max_rows * 0.9)
+        if excess > 0:
+            self._conn.execute(
+                "DELETE FROM questions WHERE hash IN "
+                "(SELECT hash FROM questions ORDER BY created_at LIMIT ?)",
+                (excess,),
+            )
+        self._conn.commit()
+        self._rows = self._conn.execute("SELECT COUNT(*) FROM questions").fetchone()[0]
+        self._hot.clear()
+
+    def sample(self, subject: str, difficulty: str, n: int) -> list[dict]:
+        """Pick up to n live questions, preferring the ones served least often."""
+        if n <= 0:
+            return []
+        now = time.time()
+        with self._lock:
+            candidates = [r for r in self._bucket(subject, difficulty) if r.expires_at > now]
+            random.shuffle(candidates)
+            candidates.sort(key=lambda r: r.served)
+            picked = candidates[:n]
+            for record in picked:
+                record.served += 1
+            if picked:
+                self._conn.executemany(
+                    "UPDATE questions SET served = served + 1 WHERE hash = ?",
+                    [(record.hash,) for record in picked],
+                )
+                self._conn.commit()
+        return [record.to_question() for record in picked]
+
+    def take(self, subject: str, difficulty: str, n: int) -> list[dict]:
+        """Remove and return up to n live questions, oldest first."""
+        if n <= 0:
+            return []
+        now = time.time()
+        with self._lock:
+            bucket = self._bucket(subject, difficulty)
+            live = sorted((r for r in bucket if r.expires_at > now), key=lambda r: r.expires_at)
+            picked = live[:n]
+            if picked:
+                taken = {record.digest for record in picked}
+                bucket[:] = [r for r in bucket if r.digest not in taken]
+                self._conn.executemany("DELETE FROM questions WHERE hash = ?", [(d.hex(),) for d in taken])
+                self._conn.commit()
+                self._rows -= len(picked)
+        return [record.to_question() for record in picked]
+
+    def count(self, subject: str, difficulty: str) -> int:
+        """Number of live questions stored for this subject and difficulty."""
+        now = time.time()
+        with self._lock:
+            return sum(1 for r in self._bucket(subject, difficulty) if r.expires_at > now)
+
+async def sync_bucket(bank: QuestionBank, subject: str, difficulty: str):
+    """Make the next read of this bucket see what other workers added or took."""
+    bank.refresh(subject, difficulty, int(await shared_state.get(bank.version_key(subject, difficulty)) or 0))
+
+async def bucket_changed(bank: QuestionBank, subject: str, difficulty: str):
+    """Tell other workers this bucket changed, after an add or take."""
+    bank.changed(subject, difficulty, await shared_state.incr(bank.version_key(subject, difficulty)))
+
+def _bench_build(kind: str, questions: int, results: "multiprocessing.Queue"):
+    """Hold `questions` hot-tier entries of one kind and report the growth in peak RSS, in bytes."""
+    import resource  # Unix only, so not imported with the module
+    from agents.fake_provider import FakeProvider
+    fake = FakeProvider("bench", seed=5)
+    expires_at = time.time() + QUESTION_BANK_TTL
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    entries = []
+    for i in range(questions):
+        if i % 40 == 0:
+            batch = fake.questions(40, "java")
+        # Fresh json.loads per question, like rows read back from SQLite: nothing is shared between them
+        question = json.loads(json.dumps(batch[i % 40]))
+        if kind == "dict":
+            entries.append({"hash": question_hash(question), "question": question, "expires_at": expires_at, "served": 0})
+        else:
+            entries.append(QuestionRecord.from_question(question, expires_at, 0))
+    # ru_maxrss is in KiB on Linux
+    results.put((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline) * 1024)
+    if kind == "record":
+        started = time.perf_counter()
+        for record in entries[:100_000]:
+            record.to_question()
+        results.put((time.perf_counter() - started) / 100_000)
+
+def _bench(questions: int = 1_000_000):
+    """
+    Hot-tier memory for 1M questions: the parsed dict entries it used to hold
+    against QuestionRecords, each built in its own process, plus the cost of
+    turning a record back into a response dict.
+    """
+    sizes = {}
+    for kind in ("dict", "record"):
+        results = multiprocessing.Queue()
+        worker = multiprocessing.Process(target=_bench_build, args=(kind, questions, results))
+        worker.start()
+        sizes[kind] = results.get() / questions
+        if kind == "record":
+            to_question = results.get()
+        worker.join()
+    print(f"{questions:,} questions: dict entries {sizes['dict']:.0f} B/question "
+          f"({sizes['dict'] * questions / 2**20:.0f} MiB), records {sizes['record']:.0f} B/question "
+          f"({sizes['record'] * questions / 2**20:.0f} MiB), {sizes['dict'] / sizes['record']:.1f}x smaller")
+    print(f"record to response dict: {to_question * 1e6:.2f} us")
+
+if __name__ == "__main__" and os.getenv("ENV") == "local":
+    _bench()
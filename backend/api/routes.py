@@ -1,145 +1,496 @@
-from fastapi import APIRouter, HTTPException
+import os
+import time
+import asyncio
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, field_validator
-from typing import Literal, Dict, Any
-import json
-import re
-from agents.java_agent import generate_java_questions
-from agents.python_agent import generate_python_questions
-from agents.sql_agent import generate_sql_questions
-from agents.r_agent import generate_r_questions
-from agents.linux_agent import generate_linux_questions
-from agents.analytics import generate_analytics_questions
-from agents.cassandra_agent import generate_cassandra_questions
-from agents.mongodb_agent import generate_mongodb_questions
+from typing import AsyncIterator, Literal
+from agents.parsing import parse_llm_response
+from agents.schema import validate_questions
+from agents.mcq_agent import generate_questions, stream_questions
+from agents.shared_state import shared_state
+from api.question_bank import QuestionBank, QUESTION_BANK_FRESH_RATIO, bucket_changed, sync_bucket
+from api.pregen import stock
+from api.coalesce import SingleFlight, shuffle_questions
+from api.dedup import DEDUP_TOP_UP_ATTEMPTS, duplicate_index
+from api.seen import SEEN_VERSION_TTL, SeenTracker
+from api.responses import json_response, ndjson_line
+from api.admission import AdmissionController, Overloaded, client_ip
+from agents.registry import SubjectSpec, all_subjects, get_subject, load_subjects
+from agents.metrics import DUPLICATES, QUESTIONS, REQUEST_SECONDS, server_timing, span, start_trace
+
+load_subjects()
+
+# Subjects of one mock paper are generated concurrently, at most this many at
+# a time across all papers. The default, one per registered subject, lets a
+# full paper run every section at once; admission control is the real limit
+PAPER_CONCURRENCY = int(os.getenv("PAPER_CONCURRENCY", "0")) or max(1, len(all_subjects()))
+PAPER_MAX_QUESTIONS = int(os.getenv("PAPER_MAX_QUESTIONS", "120"))
 
 router = APIRouter()
+question_bank = QuestionBank()
+single_flight = SingleFlight()
+seen_tracker = SeenTracker()
+admission = AdmissionController()
+paper_slots = asyncio.Semaphore(PAPER_CONCURRENCY)
 
 class QuestionRequest(BaseModel):
     subject: str
     difficulty: Literal["easy", "medium", "hard"]
-    num_questions: int
+    num_questions: int | None = None  # None uses the subject's default
     api_key: str | None = None
     fallback_api_key: str | None = None
     fallback_model: str = "gpt-3.5-turbo"
+    # Stable per-user or per-session token; questions already served to it are skipped
+    user_token: str | None = None
 
     @field_validator("num_questions")
     @classmethod
     def validate_num_questions(cls, v):
-        if v < 1 or v > 40:
+        if v is not None and (v < 1 or v > 40):
             raise ValueError("num_questions must be between 1 and 40")
         return v
-    
-def parse_llm_response(raw: str) -> Dict[str, Any]:
-    """Extract and parse JSON from LLM response robustly."""
-    
-    try:
-        return json.loads(raw.strip())
-    except json.JSONDecodeError:
-        pass
-    
-    json_match = re.search(r'``````', raw, re.DOTALL)
-    if json_match:
-        try:
-            return json.loads(json_match.group(1))
-        except json.JSONDecodeError:
-            pass
-    
-    start = raw.find("{")
-    if start != -1:
-        depth = 0
-        for i, char in enumerate(raw[start:], start):
-            if char == "{":
-                depth += 1
-            elif char == "}":
-                depth -= 1
-                if depth == 0:
-                    try:
-                        return json.loads(raw[start:i+1])
-                    except json.JSONDecodeError:
-                        break
-    
-    raise ValueError("Could not parse valid JSON from LLM response")
 
-@router.post("/generate-questions")
-async def generate_questions_api(req:QuestionRequest):
-    subject = req.subject.lower().strip()
+class PaperRequest(BaseModel):
+    subjects: dict[str, int]  # subject -> number of questions, e.g. {"java": 10, "sql": 10, "linux": 5}
+    difficulty: Literal["easy", "medium", "hard"]
+    api_key: str | None = None
+    fallback_api_key: str | None = None
+    fallback_model: str = "gpt-3.5-turbo"
+    user_token: str | None = None
 
-    if subject == 'java':
-        raw = await generate_java_questions(
-            difficulty = req.difficulty,
-            num_questions = req.num_questions,
-            api_key = req.api_key,
-            fallback_api_key=req.fallback_api_key,
-            fallback_model=req.fallback_model
-        )
-    elif subject == 'python':
-        raw = await generate_python_questions(
-           difficulty = req.difficulty,
-            num_questions = req.num_questions,
-            api_key = req.api_key,
-            fallback_api_key=req.fallback_api_key,
-            fallback_model=req.fallback_model
-        )
-    elif subject in ("sql", "dbms"):
-        raw = await generate_sql_questions(
-            difficulty=req.difficulty,
-            num_questions=req.num_questions,
-            api_key=req.api_key,
-            fallback_api_key=req.fallback_api_key,
-            fallback_model=req.fallback_model
-        )
-    elif subject in ("r"):
-        raw = await generate_r_questions(
-            difficulty=req.difficulty,
-            num_questions=req.num_questions,
-            api_key=req.api_key,
-            fallback_api_key=req.fallback_api_key,
-            fallback_model=req.fallback_model
+    @field_validator("subjects")
+    @classmethod
+    def validate_subjects(cls, v):
+        if not v:
+            raise ValueError("subjects must not be empty")
+        if any(n < 1 or n > 40 for n in v.values()):
+            raise ValueError("each subject needs between 1 and 40 questions")
+        if sum(v.values()) > PAPER_MAX_QUESTIONS:
+            raise ValueError(f"a paper can have at most {PAPER_MAX_QUESTIONS} questions")
+        return v
+
+def resolve_subject(req: QuestionRequest) -> SubjectSpec:
+    """Look up the requested subject and fill in its default size."""
+    spec = get_subject(req.subject)
+    if spec is None:
+        raise HTTPException(status_code=400,detail=f'Unsupported subjects:{req.subject}')
+    if req.num_questions is None:
+        req.num_questions = spec.default_num_questions
+    if req.num_questions > spec.max_questions:
+        raise HTTPException(
+            status_code=400,
+            detail=f"num_questions must be at most {spec.max_questions} for {spec.id}",
         )
-    elif subject in ("linux"):
-        raw = await generate_linux_questions(
-            difficulty=req.difficulty,
-            num_questions=req.num_questions,
-            api_key=req.api_key,
-            fallback_api_key=req.fallback_api_key,
-            fallback_model=req.fallback_model
+    return spec
+
+async def filter_seen(user_token: str | None, questions: list[dict]) -> tuple[list[dict], list[dict]]:
+    """(unseen, seen) for the user; everything counts as unseen without a token."""
+    if not user_token or not questions:
+        return questions, []
+    version = int(await shared_state.get(seen_tracker.version_key(user_token)) or 0)
+    return await asyncio.to_thread(seen_tracker.filter_unseen, user_token, questions, version)
+
+async def take_cached(
+    spec: SubjectSpec, difficulty: str, num_questions: int, user_token: str | None = None
+) -> tuple[list, list]:
+    """Pre-generated stock first, then part of the rest from previously served questions."""
+    fresh_ratio = QUESTION_BANK_FRESH_RATIO if spec.fresh_ratio is None else spec.fresh_ratio
+    with span("cache"):
+        await sync_bucket(stock, spec.id, difficulty)
+        stocked = await asyncio.to_thread(stock.take, spec.id, difficulty, num_questions)
+        if stocked:
+            await bucket_changed(stock, spec.id, difficulty)
+        stocked, returned = await filter_seen(user_token, stocked)
+        if returned:
+            # Seen by this user, still new to everyone else
+            await bank_add(stock, spec.id, difficulty, returned, 0)
+        # Stock was checked against the history when it was generated; similar
+        # questions may have been served since
+        stocked, _ = await dedup_questions(spec, stocked)
+        wanted = int((num_questions - len(stocked)) * (1 - fresh_ratio))
+        # Oversample so questions this user has already seen can be skipped
+        await sync_bucket(question_bank, spec.id, difficulty)
+        banked = await asyncio.to_thread(
+            question_bank.sample, spec.id, difficulty, wanted * 2 if user_token else wanted
         )
-    elif subject in ("analytics"):
-        raw = await generate_analytics_questions(
-            difficulty=req.difficulty,
-            num_questions=req.num_questions,
-            api_key=req.api_key,
-            fallback_api_key=req.fallback_api_key,
-            fallback_model=req.fallback_model
+        banked, _ = await filter_seen(user_token, banked)
+        # Bank questions are repeats on purpose, and joined the history when first served,
+        # so they are only checked against this response and not recorded again
+        banked, _ = await dedup_questions(spec, banked[:wanted], history=False, record=False, batch=stocked)
+    QUESTIONS.labels(spec.id, "stock").inc(len(stocked))
+    QUESTIONS.labels(spec.id, "bank").inc(len(banked))
+    return stocked, banked
+
+async def bank_add(bank: QuestionBank, subject: str, difficulty: str, questions: list[dict], served: int = 1):
+    """Store questions; if any were new, let other workers know the bucket changed."""
+    if await asyncio.to_thread(bank.add, subject, difficulty, questions, served):
+        await bucket_changed(bank, subject, difficulty)
+
+async def generate_raw(spec: SubjectSpec, req: QuestionRequest, num_questions: int) -> str:
+    """Generate with the subject's instruction and tuning, returning the raw LLM text."""
+    return await generate_questions(
+        subject=spec.name,
+        difficulty=req.difficulty,
+        num_questions=num_questions,
+        api_key=req.api_key,
+        fallback_api_key=req.fallback_api_key,
+        fallback_model=req.fallback_model,
+        extra_instruction=spec.instruction,
+        model=spec.model,
+        shard_size=spec.shard_size,
+        topics=spec.topics,
+    )
+
+async def dedup_questions(
+    spec: SubjectSpec, questions: list[dict], history: bool = True, record: bool = True, batch: list[dict] = ()
+) -> tuple[list[dict], list[dict]]:
+    """
+    (unique, duplicates) against each other, batch (questions already in the
+    response) and, if history, the served history; with record, unique ones
+    join the history.
+    """
+    if duplicate_index is None or not questions:
+        return questions, []
+    with span("dedup"):
+        unique, duplicates = await asyncio.to_thread(
+            duplicate_index.filter, spec.id, questions, history=history, record=record, batch=batch
         )
-    elif subject in ("cassandra"):
-        raw = await generate_cassandra_questions(
-            difficulty=req.difficulty,
-            num_questions=req.num_questions,
-            api_key=req.api_key,
-            fallback_api_key=req.fallback_api_key,
-            fallback_model=req.fallback_model
+    if duplicates:
+        DUPLICATES.labels(spec.id).inc(len(duplicates))
+    return unique, duplicates
+
+def validate(spec: SubjectSpec, questions: list[dict]) -> list[dict]:
+    with span("validate"):
+        return validate_questions(spec.id, questions)
+
+async def _top_up(spec: SubjectSpec, req: QuestionRequest, missing: int) -> list[dict]:
+    """
+    Small extra generation for just the questions that are missing: invalid,
+    cut off, dropped as duplicates or already seen.
+    """
+    added = []
+    for _ in range(DEDUP_TOP_UP_ATTEMPTS):
+        if len(added) >= missing:
+            break
+        try:
+            with span("top_up"):
+                raw = await generate_raw(spec, req, missing - len(added))
+            questions = validate(spec, parse_llm_response(raw).get("questions", []))
+        except Exception as e:
+            print(f"Top-up for {spec.id} failed: {e}")
+            break
+        unique, _ = await dedup_questions(spec, questions)
+        unique, _ = await filter_seen(req.user_token, unique)
+        added += unique[:missing - len(added)]
+    return added
+
+async def record_seen(user_token: str | None, questions: list[dict]):
+    if not user_token or not questions:
+        return
+    key = seen_tracker.version_key(user_token)
+    version = int(await shared_state.get(key) or 0)
+    if await asyncio.to_thread(seen_tracker.record, user_token, questions, version):
+        seen_tracker.changed(user_token, await shared_state.incr(key, ttl=SEEN_VERSION_TTL))
+
+async def generate_fresh(spec: SubjectSpec, req: QuestionRequest, num_questions: int) -> list[dict]:
+    """
+    New questions for the request: generated, parsed, validated and
+    deduplicated. Whatever that leaves short is replaced by one top-up for
+    only the missing count, not a full regeneration.
+    """
+    raw = await generate_raw(spec, req, num_questions)
+    try:
+        with span("parse"):
+            parsed = parse_llm_response(raw)
+        questions = parsed.get("questions", [])
+    except ValueError as e:
+        raise HTTPException(status_code=500, detail=f"Failed to parse LLM response: {e}")
+
+    questions, duplicates = await dedup_questions(spec, validate(spec, questions))
+    if len(questions) < num_questions:
+        questions += await _top_up(spec, req, num_questions - len(questions))
+        # A repeat is still better than a short test; an invalid question is not
+        questions += duplicates[:num_questions - len(questions)]
+    return questions
+
+@router.post("/generate-questions")
+async def generate_questions_api(req:QuestionRequest, request: Request):
+    subject = req.subject.lower().strip()
+    spec = resolve_subject(req)
+    started = time.perf_counter()
+    spans = start_trace()
+    try:
+        async with admission.admit(request_ip(request), req.api_key, req.num_questions):
+            reply = json_response(request, await _generate_questions(spec, subject, req))
+    finally:
+        REQUEST_SECONDS.labels("generate", spec.id, req.difficulty).observe(time.perf_counter() - started)
+    reply.headers["Server-Timing"] = server_timing(spans)
+    return reply
+
+async def _generate_questions(spec: SubjectSpec, subject: str, req: QuestionRequest) -> dict:
+    stocked, banked = await take_cached(spec, req.difficulty, req.num_questions, req.user_token)
+    num_fresh = req.num_questions - len(stocked) - len(banked)
+    if num_fresh == 0:
+        if stocked:
+            await bank_add(question_bank, spec.id, req.difficulty, stocked)
+        await record_seen(req.user_token, stocked + banked)
+        return {
+            "subject": subject,
+            "difficulty": req.difficulty,
+            "num_questions": req.num_questions,
+            "questions": [{**q, "id": i} for i, q in enumerate(stocked + banked, 1)],
+        }
+
+    # Identical concurrent requests share one upstream call
+    with span("generate"):
+        questions, shared = await single_flight.do(
+            (spec.id, req.difficulty, num_fresh),
+            lambda: generate_fresh(spec, req, num_fresh),
         )
-    elif subject in ("mongodb"):
-        raw = await generate_mongodb_questions(
+    if shared:
+        questions = shuffle_questions(questions)
+    questions, seen = await filter_seen(req.user_token, questions)
+    if seen:
+        questions += await _top_up(spec, req, len(seen))
+        questions += seen[:num_fresh - len(questions)]
+    QUESTIONS.labels(spec.id, "shared" if shared else "fresh").inc(len(questions))
+
+    with span("bank_add"):
+        await bank_add(question_bank, spec.id, req.difficulty, stocked + questions)
+    await record_seen(req.user_token, stocked + banked + questions)
+    questions = [{**q, "id": i} for i, q in enumerate(stocked + banked + questions, 1)]
+    normalized = {
+        "subject": subject,
+        "difficulty": req.difficulty,
+        "num_questions": req.num_questions,
+        "questions": questions,
+    }
+    return normalized
+
+def request_ip(request: Request) -> str:
+    return client_ip(request.headers, request.client.host if request.client else None)
+
+async def charge_stream(request: Request, api_key: str | None, cost: int) -> tuple[str, str]:
+    """
+    Rate-limit a streaming request before its 200 goes out, so an overloaded
+    server can still answer 429. The concurrency slot is taken in the stream.
+    """
+    charged = await admission.charge(request_ip(request), api_key, cost)
+    try:
+        admission.gate.check()
+    except Exception:
+        await admission.refund(charged, cost)
+        raise
+    return charged
+
+def resolve_paper(req: PaperRequest) -> list[tuple[SubjectSpec, QuestionRequest]]:
+    """One (spec, request) section per subject, in request order."""
+    sections = []
+    for subject, num_questions in req.subjects.items():
+        section = QuestionRequest(
+            subject=subject,
             difficulty=req.difficulty,
-            num_questions=req.num_questions,
+            num_questions=num_questions,
             api_key=req.api_key,
             fallback_api_key=req.fallback_api_key,
-            fallback_model=req.fallback_model
+            fallback_model=req.fallback_model,
+            user_token=req.user_token,
         )
-    else:
-        raise HTTPException(status_code=400,detail=f'Unsupported subjects:{req.subject}')
-    
+        sections.append((resolve_subject(section), section))
+    ids = [spec.id for spec, _ in sections]
+    if len(set(ids)) != len(ids):
+        raise HTTPException(status_code=400, detail="Each subject may appear only once in a paper")
+    return sections
+
+@router.post("/generate-paper")
+async def generate_paper_api(req: PaperRequest, request: Request):
+    """
+    Mock paper across several subjects. Sections are generated concurrently,
+    so a full paper takes about as long as its slowest subject. Sections that
+    fail are reported under "errors" instead of failing the whole paper.
+    """
+    sections = resolve_paper(req)
+    started = time.perf_counter()
+    spans = start_trace()
+
+    async def section(spec: SubjectSpec, section_req: QuestionRequest) -> dict:
+        async with paper_slots:
+            result = await _generate_questions(spec, spec.id, section_req)
+        REQUEST_SECONDS.labels("paper_section", spec.id, req.difficulty).observe(time.perf_counter() - started)
+        return result
+
     try:
-        parsed = parse_llm_response(raw)
-        questions = parsed.get("questions", [])
-        normalized = {
+        async with admission.admit(request_ip(request), req.api_key, sum(req.subjects.values())):
+            results = await asyncio.gather(
+                *(section(spec, section_req) for spec, section_req in sections),
+                return_exceptions=True,
+            )
+    finally:
+        REQUEST_SECONDS.labels("paper", "all", req.difficulty).observe(time.perf_counter() - started)
+
+    done, errors = [], {}
+    for (spec, _), result in zip(sections, results):
+        if isinstance(result, HTTPException):
+            errors[spec.id] = result.detail
+        elif isinstance(result, Exception):
+            errors[spec.id] = str(result)
+        else:
+            done.append(result)
+    if not done:
+        raise HTTPException(status_code=500, detail=f"Failed to generate paper: {errors}")
+    reply = json_response(request, {
+        "difficulty": req.difficulty,
+        "num_questions": sum(len(s["questions"]) for s in done),
+        "sections": done,
+        "errors": errors,
+    })
+    reply.headers["Server-Timing"] = server_timing(spans)
+    return reply
+
+async def _stream_section(spec: SubjectSpec, req: QuestionRequest) -> AsyncIterator[dict]:
+    """Questions for one subject as soon as each is available: cached ones first, then streamed fresh ones."""
+    fresh, duplicates = [], []
+    stocked, banked = await take_cached(spec, req.difficulty, req.num_questions, req.user_token)
+    try:
+        for question in stocked + banked:
+            yield question
+        remaining = req.num_questions - len(stocked) - len(banked)
+        if remaining > 0:
+            async for question in stream_questions(
+                subject=spec.name,
+                difficulty=req.difficulty,
+                num_questions=remaining,
+                api_key=req.api_key,
+                fallback_api_key=req.fallback_api_key,
+                fallback_model=req.fallback_model,
+                extra_instruction=spec.instruction,
+                model=spec.model,
+                shard_size=spec.shard_size,
+                topics=spec.topics,
+            ):
+                unique, repeated = await dedup_questions(spec, validate(spec, [question]))
+                unique, seen = await filter_seen(req.user_token, unique)
+                duplicates += repeated + seen
+                for question in unique:
+                    fresh.append(question)
+                    yield question
+            if len(fresh) < remaining:
+                for question in await _top_up(spec, req, remaining - len(fresh)) + duplicates:
+                    if len(fresh) >= remaining:
+                        break
+                    fresh.append(question)
+                    yield question
+    finally:
+        QUESTIONS.labels(spec.id, "fresh").inc(len(fresh))
+        await bank_add(question_bank, spec.id, req.difficulty, stocked + fresh)
+        await record_seen(req.user_token, stocked + banked + fresh)
+
+@router.post("/generate-questions/stream")
+async def stream_questions_api(req: QuestionRequest, request: Request):
+    """
+    Same request as /generate-questions, answered as NDJSON: one
+    {"type": "question"} line per question as soon as it is complete,
+    then a {"type": "done"} line (or {"type": "error"} on failure).
+    """
+    subject = req.subject.lower().strip()
+    spec = resolve_subject(req)
+    ip = request_ip(request)
+    charged = await charge_stream(request, req.api_key, req.num_questions)
+
+    async def lines():
+        started = time.perf_counter()
+        start_trace()
+        first_question_ms = None
+        sent = 0
+        try:
+            async with admission.admit(ip, req.api_key, req.num_questions, charged):
+                async for question in _stream_section(spec, req):
+                    sent += 1
+                    if first_question_ms is None:
+                        first_question_ms = (time.perf_counter() - started) * 1000
+                    yield ndjson_line({"type": "question", "question": {**question, "id": sent}})
+        except Exception as e:
+            yield ndjson_line({"type": "error", "detail": str(e)})
+            return
+        finally:
+            REQUEST_SECONDS.labels("stream", spec.id, req.difficulty).observe(time.perf_counter() - started)
+
+        yield ndjson_line({
+            "type": "done",
             "subject": subject,
             "difficulty": req.difficulty,
-            "num_questions": req.num_questions,
-            "questions": questions,
-        }
-        return normalized
-    except ValueError as e:
-        raise HTTPException(status_code=500, detail=f"Failed to parse LLM response: {e}")
\ No newline at end of file
+            "num_questions": sent,
+            "time_to_first_question_ms": first_question_ms,
+        })
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+@router.post("/generate-paper/stream")
+async def stream_paper_api(req: PaperRequest, request: Request):
+    """
+    Streaming /generate-paper. All sections stream concurrently into one NDJSON
+    response: {"type": "question", "subject": ...} lines numbered across the
+    paper, a {"type": "section_done"} or {"type": "error", "subject": ...} line
+    per subject, then a final {"type": "done"} line.
+    """
+    sections = resolve_paper(req)
+    ip = request_ip(request)
+    cost = sum(req.subjects.values())
+    charged = await charge_stream(request, req.api_key, cost)
+
+    async def lines():
+        try:
+            async with admission.admit(ip, req.api_key, cost, charged):
+                async for line in paper_lines():
+                    yield line
+        except Overloaded as e:
+            yield ndjson_line({"type": "error", "detail": f"Server busy ({e.reason}), retry in {e.retry_after:.0f}s"})
+
+    async def paper_lines():
+        started = time.perf_counter()
+        start_trace()
+        queue: asyncio.Queue = asyncio.Queue()
+
+        async def pump(spec: SubjectSpec, section_req: QuestionRequest):
+            try:
+                async with paper_slots:
+                    async for question in _stream_section(spec, section_req):
+                        await queue.put((spec, question))
+                await queue.put((spec, None))
+            except Exception as e:
+                await queue.put((spec, e))
+
+        tasks = [asyncio.create_task(pump(spec, section_req)) for spec, section_req in sections]
+        first_question_ms = None
+        counts = {spec.id: 0 for spec, _ in sections}
+        finished = 0
+        try:
+            while finished < len(tasks):
+                spec, item = await queue.get()
+                if item is None or isinstance(item, Exception):
+                    finished += 1
+                    if item is None:
+                        yield ndjson_line({"type": "section_done", "subject": spec.id, "num_questions": counts[spec.id]})
+                    else:
+                        yield ndjson_line({"type": "error", "subject": spec.id, "detail": str(item)})
+                    continue
+                counts[spec.id] += 1
+                if first_question_ms is None:
+                    first_question_ms = (time.perf_counter() - started) * 1000
+                question = {**item, "id": sum(counts.values())}
+                yield ndjson_line({"type": "question", "subject": spec.id, "question": question})
+        finally:
+            for task in tasks:
+                task.cancel()
+            REQUEST_SECONDS.labels("paper_stream", "all", req.difficulty).observe(time.perf_counter() - started)
+
+        yield ndjson_line({
+            "type": "done",
+            "difficulty": req.difficulty,
+            "num_questions": sum(counts.values()),
+            "subjects": counts,
+            "time_to_first_question_ms": first_question_ms,
+        })
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
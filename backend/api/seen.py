@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import struct
+import random
+import sqlite3
+import hashlib
+import threading
+from array import array
+from bisect import bisect_left, insort
+from collections import OrderedDict
+
+SEEN_PATH = os.getenv("SEEN_PATH", "question_seen.sqlite3")
+# Users whose seen sets are kept in memory; the rest are read back from SQLite on demand
+SEEN_CACHE_USERS = int(os.getenv("SEEN_CACHE_USERS", "20000"))
+# Per-user cap; past it the older half of the user's history is forgotten
+SEEN_MAX_PER_USER = int(os.getenv("SEEN_MAX_PER_USER", "20000"))
+# Lifetime of a user's version stamp in shared state, after which it starts again from 0
+SEEN_VERSION_TTL = 30 * 24 * 3600
+
+def content_id(question: dict) -> int:
+    """Stable 32-bit content hash of a question (text and options), independent of its id."""
+    body = json.dumps([question.get("question"), question.get("options")], sort_keys=True)
+    return int.from_bytes(hashlib.blake2b(body.encode("utf-8"), digest_size=4).digest(), "little")
+
+class SeenSet:
+    """
+    Sorted uint32 arrays of content ids: 4 bytes per question and a binary
+    search per lookup. This is a roaring bitmap's array container spanning
+    the whole 32-bit range. Content hashes are uniform, so per-16-bit roaring
+    containers would almost all hold a single id and cost more than the ids.
+    Ids go into `current` until it reaches half the cap. Then `current`
+    becomes `previous` and the old `previous` is dropped, so a set never
+    holds more than max_size ids. version is the shared version the set was
+    loaded at, so a copy another worker has since changed can be reloaded.
+    """
+
+    __slots__ = ("current", "previous", "max_size", "version")
+
+    def __init__(self, max_size: int = SEEN_MAX_PER_USER):
+        self.current = array("I")
+        self.previous = array("I")
+        self.max_size = max_size
+        self.version = 0
+
+    @staticmethod
+    def _has(ids: array, value: int) -> bool:
+        i = bisect_left(ids, value)
+        return i < len(ids) and ids[i] == value
+
+    def __contains__(self, value: int) -> bool:
+        return self._has(self.current, value) or self._has(self.previous, value)
+
+    def __len__(self) -> int:
+        return len(self.current) + len(self.previous)
+
+    def seen_mask(self, values: list[int]) -> list[bool]:
+        """Batch membership check, one flag per value."""
+        return [value in self for value in values]
+
+    def add_many(self, values: list[int]) -> int:
+        """Add ids, returning how many were new."""
+        added = 0
+        for value in values:
+            if value in self:
+                continue
+            if len(self.current) >= self.max_size // 2:
+                self.previous, self.current = self.current, array("I")
+            insort(self.current, value)
+            added += 1
+        return added
+
+    def to_bytes(self) -> bytes:
+        return struct.pack("<I", len(self.current)) + self.current.tobytes() + self.previous.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes, max_size: int = SEEN_MAX_PER_USER) -> "SeenSet":
+        seen = cls(max_size)
+        (split,) = struct.unpack_from("<I", data)
+        ids = array("I", data[4:])
+        seen.current, seen.previous = ids[:split], ids[split:]
+        return seen
+
+class SeenTracker:
+    """
+    Per-user seen sets in SQLite with an LRU of the most recently active users
+    in memory, so memory stays bounded however many users there are. Users
+    are identified by a hash of their token; raw tokens are never stored.
+    Callers pass the user's version from shared state, so a set another
+    worker has recorded to since it was cached is read back from SQLite.
+    """
+
+    def __init__(self, path: str = SEEN_PATH, cache_users: int = SEEN_CACHE_USERS, max_per_user: int = SEEN_MAX_PER_USER):
+        self.cache_users = cache_users
+        self.max_per_user = max_per_user
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[str, SeenSet]" = OrderedDict()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS seen (
+                user TEXT PRIMARY KEY,
+                ids BLOB NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def user_key(token: str) -> str:
+        return hashlib.blake2b(token.encode("utf-8"), digest_size=16).hexdigest()
+
+    def version_key(self, token: str) -> str:
+        return f"seen:{self.user_key(token)}"
+
+    def _get(self, user: str, version: int) -> SeenSet:
+        seen = self._cache.get(user)
+        if seen is not None and seen.version == version:
+            self._cache.move_to_end(user)
+            return seen
+
+        row = self._conn.execute("SELECT ids FROM seen WHERE user = ?", (user,)).fetchone()
+        seen = SeenSet.from_bytes(row[0], self.max_per_user) if row else SeenSet(self.max_per_user)
+        seen.version = version
+        self._cache[user] = seen
+        self._cache.move_to_end(user)
+        while len(self._cache) > self.cache_users:
+            self._cache.popitem(last=False)
+        return seen
+
+    def filter_unseen(self, token: str, questions: list[dict], version: int = 0) -> tuple[list[dict], list[dict]]:
+        """Split questions into (unseen, seen) for this user."""
+        with self._lock:
+            mask = self._get(self.user_key(token), version).seen_mask([content_id(q) for q in questions])
+        unseen = [q for q, seen in zip(questions, mask) if not seen]
+        seen = [q for q, seen in zip(questions, mask) if seen]
+        return unseen, seen
+
+    def record(self, token: str, questions: list[dict], version: int = 0) -> bool:
+        """Mark questions as served to this user. Returns whether any were new."""
+        if not questions:
+            return False
+        user = self.user_key(token)
+        with self._lock:
+            seen = self._get(user, version)
+            if not seen.add_many([content_id(q) for q in questions]):
+                return False
+            self._conn.execute(
+                "INSERT INTO seen VALUES (?, ?, ?) "
+                "ON CONFLICT(user) DO UPDATE SET ids = excluded.ids, updated_at = excluded.updated_at",
+                (user, seen.to_bytes(), time.time()),
+            )
+            self._conn.commit()
+        return True
+
+    def changed(self, token: str, version: int):
+        """Note this process's own record(); the cached set is current unless another worker recorded in between."""
+        with self._lock:
+            seen = self._cache.get(self.user_key(token))
+            if seen is not None and seen.version == version - 1:
+                seen.version = version
+
+def _bench(users: int = 20_000, per_user: int = 500, checks: int = 20_000):
+    """Memory per user, extrapolated to 100k users, and batch check latency for a 40-question paper."""
+    rng = random.Random(3)
+    sets = []
+    for _ in range(users):
+        seen = SeenSet()
+        seen.add_many(sorted(rng.getrandbits(32) for _ in range(per_user)))
+        sets.append(seen)
+    per_set = sum(len(s.to_bytes()) for s in sets) / users
+    print(f"{per_user} seen questions: {per_set / 1024:.1f} KiB per user, "
+          f"{per_set * 100_000 / 2**20:.0f} MiB on disk for 100k users, "
+          f"{per_set * SEEN_CACHE_USERS / 2**20:.0f} MiB for the in-memory LRU of {SEEN_CACHE_USERS}")
+
+    batch = [rng.getrandbits(32) for _ in range(40)]
+    started = time.perf_counter()
+    for i in range(checks):
+        sets[i % users].seen_mask(batch)
+    print(f"seen check of 40 ids: {(time.perf_counter() - started) / checks * 1e6:.1f} us")
+
+if __name__ == "__main__" and os.getenv("ENV") == "local":
+    _bench()
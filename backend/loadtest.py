@@ -0,0 +1,132 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+from collections import Counter
+
+def configure(args: argparse.Namespace, workdir: str):
+    """Point the app at the fake providers and throwaway SQLite files. Must run before `import main`."""
+    os.environ.update(
+        MCQ_PROVIDER="fake",
+        FAKE_LLM_LATENCY=args.latency,
+        FAKE_LLM_TOKENS_PER_SECOND=str(args.tokens_per_second),
+        FAKE_LLM_ERROR_RATE=str(args.error_rate),
+        FAKE_LLM_QUOTA_RATE=str(args.quota_rate),
+        FAKE_LLM_TRUNCATE_RATE=str(args.truncate_rate),
+        FAKE_LLM_SEED=str(args.seed),
+        QUESTION_BANK_FRESH_RATIO=str(args.fresh_ratio),
+        QUESTION_BANK_PATH=os.path.join(workdir, "question_bank.sqlite3"),
+        PREGEN_STOCK_PATH=os.path.join(workdir, "question_stock.sqlite3"),
+        DEDUP_PATH=os.path.join(workdir, "question_history.sqlite3"),
+        SEEN_PATH=os.path.join(workdir, "question_seen.sqlite3"),
+        PREGEN_ENABLED="0",
+    )
+    # All load comes from one client, so per-client rate limits are lifted unless asked for
+    if not args.rate_limits:
+        for name in ("RATE_LIMIT_IP_BURST", "RATE_LIMIT_KEY_BURST"):
+            os.environ[name] = "1e9"
+        for name in ("RATE_LIMIT_IP_PER_MINUTE", "RATE_LIMIT_KEY_PER_MINUTE"):
+            os.environ[name] = "1e9"
+
+def percentile(values: list[float], q: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+def counts(metric, label: str) -> Counter:
+    """Current counter values summed by one label."""
+    totals = Counter()
+    for _, labels, value in metric.samples():
+        totals[labels[label]] += value
+    return totals
+
+async def run_load_test(args: argparse.Namespace):
+    import httpx
+    import main
+    from agents import metrics
+    from agents.mcq_agent import warm_sdk
+    from agents.registry import all_subjects
+
+    rng = random.Random(args.seed)
+    subjects = [spec.id for spec in all_subjects()]
+    users = [f"loadtest-user-{i}" for i in range(args.users)]
+    sizes = [int(size) for size in args.num_questions.split(",")]
+    levels = [int(level) for level in args.concurrency.split(",")]
+    # The Gemini slot runs the real ADK Runner over a fake model, so import it before the clock starts
+    await warm_sdk()
+
+    async def run_level(client: httpx.AsyncClient, concurrency: int):
+        latencies, statuses = [], Counter()
+        questions = 0
+        sent = 0
+
+        async def worker():
+            nonlocal questions, sent
+            while sent < args.requests:
+                sent += 1
+                body = {
+                    "subject": rng.choice(subjects),
+                    "difficulty": rng.choice(("easy", "medium", "hard")),
+                    "num_questions": rng.choice(sizes),
+                    "api_key": "loadtest",
+                    "user_token": rng.choice(users) if users else None,
+                }
+                if args.fallback:
+                    body["fallback_api_key"] = "loadtest-fallback"
+                started = time.perf_counter()
+                response = await client.post("/api/generate-questions", json=body)
+                statuses[response.status_code] += 1
+                if response.status_code == 200:
+                    latencies.append(time.perf_counter() - started)
+                    questions += len(response.json()["questions"])
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        latencies.sort()
+        print(f"concurrency {concurrency:>4}: {len(latencies) / elapsed:7.1f} req/s, "
+              f"{questions / elapsed:6.0f} questions/s, p50 {percentile(latencies, 0.5) * 1000:.0f} ms, "
+              f"p95 {percentile(latencies, 0.95) * 1000:.0f} ms, p99 {percentile(latencies, 0.99) * 1000:.0f} ms, "
+              "status " + ", ".join(f"{code}: {n}" for code, n in sorted(statuses.items())))
+
+    print(f"{args.requests} requests per level, fake latency {args.latency} "
+          f"at {args.tokens_per_second:g} tok/s, errors {args.error_rate:.0%}, 429s {args.quota_rate:.0%}, "
+          f"truncated {args.truncate_rate:.0%}")
+    # Unhandled errors become 500s as they would behind uvicorn, instead of aborting the run
+    transport = httpx.ASGITransport(app=main.app, raise_app_exceptions=False)
+    async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=None) as client:
+        for concurrency in levels:
+            await run_level(client, concurrency)
+
+    parses = counts(metrics.PARSES, "result")
+    sources = counts(metrics.QUESTIONS, "source")
+    fallbacks = counts(metrics.FALLBACKS, "reason")
+    retries = sum(value for _, _, value in metrics.RETRIES.samples())
+    total_parses = sum(parses.values()) or 1
+    print(f"parses {dict(parses)}, salvage rate {parses['salvaged'] / total_parses:.1%}, "
+          f"failed {parses['failed'] / total_parses:.1%}")
+    print(f"questions by source {dict(sources)}, fallbacks {dict(fallbacks)}, shard retries {retries:g}")
+
+def parse_args(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Drive /api/generate-questions offline against the fake LLM providers.")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", default="32", help="comma-separated concurrency levels to sweep, e.g. 1,8,32,128")
+    parser.add_argument("--num-questions", default="5,10,20", help="comma-separated request sizes to pick from")
+    parser.add_argument("--users", type=int, default=200, help="distinct user tokens; 0 sends none")
+    parser.add_argument("--latency", default="lognormal:0.8:0.5", help="fake first-token latency distribution")
+    parser.add_argument("--tokens-per-second", type=float, default=2000)
+    parser.add_argument("--error-rate", type=float, default=0.02)
+    parser.add_argument("--quota-rate", type=float, default=0.0)
+    parser.add_argument("--truncate-rate", type=float, default=0.05)
+    parser.add_argument("--fresh-ratio", type=float, default=1.0, help="share generated fresh vs. served from the bank")
+    parser.add_argument("--fallback", action="store_true", help="send a fallback key, enabling hedging")
+    parser.add_argument("--rate-limits", action="store_true", help="keep the per-IP/per-key rate limits")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+if __name__ == "__main__" and os.getenv("ENV") == "local":
+    args = parse_args(sys.argv[1:])
+    with tempfile.TemporaryDirectory() as workdir:
+        configure(args, workdir)
+        asyncio.run(run_load_test(args))
@@ -1,8 +1,39 @@
+import os
+import sys
+import asyncio
+import subprocess
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from api.routes import router as api_router
+from api.pregen import PREGEN_ENABLED, run_pregen
+from api.admission import Overloaded, retry_after_header
+from agents.mcq_agent import warm_sdk
+from agents.fake_provider import install_fake_providers
+from agents import metrics
 
-app = FastAPI()
+# "fake" serves every generation from agents.fake_provider, for offline load tests
+MCQ_PROVIDER = os.getenv("MCQ_PROVIDER", "live")
+# Import the provider SDKs in the background right after startup instead of on the first request
+SDK_WARMUP = os.getenv("SDK_WARMUP", "1") == "1"
+# Modules that must not be imported by `import main`; they are loaded lazily
+LAZY_MODULES = ("google.adk", "google.genai", "litellm")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    warmup_task = asyncio.create_task(warm_sdk()) if SDK_WARMUP else None
+    pregen_task = asyncio.create_task(run_pregen()) if PREGEN_ENABLED else None
+    yield
+    if pregen_task:
+        pregen_task.cancel()
+    if warmup_task:
+        warmup_task.cancel()
+
+if MCQ_PROVIDER == "fake":
+    install_fake_providers()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -14,6 +45,53 @@ app.add_middleware(
 
 app.include_router(api_router,prefix="/api")
 
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request, exc: Overloaded):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": f"Too many requests ({exc.reason}), retry in {exc.retry_after:.0f}s"},
+        headers=retry_after_header(exc.retry_after),
+    )
+
 @app.get("/health")
 async def health_check():
-    return {"status": "ok"}
\ No newline at end of file
+    return {"status": "ok"}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+def _bench(target: str = "main", top: int = 15, budget_ms: float = 2000):
+    """
+    Import-time report for a cold `import main` (python -X importtime), and a
+    check that the provider SDKs stay out of the startup path.
+    """
+    check = f"import sys, {target}; print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", check],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    # stderr lines: "import time: self [us] | cumulative | imported package"
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        imports.append((int(cumulative), name.rstrip()[1:]))
+    total_ms = sum(cumulative for cumulative, name in imports if not name.startswith(" ")) / 1000
+
+    print(f"cold import of {target}: {total_ms:.0f} ms ({len(imports)} modules)")
+    for cumulative, name in sorted(imports, reverse=True)[:top]:
+        print(f"{cumulative / 1000:9.1f} ms  {name}")
+
+    eager = result.stdout.strip()
+    if result.returncode != 0:
+        print(result.stderr.splitlines()[-1])
+        sys.exit(1)
+    if eager or total_ms > budget_ms:
+        print(f"FAIL: eager SDK imports [{eager}], {total_ms:.0f} ms vs budget {budget_ms:.0f} ms")
+        sys.exit(1)
+    print(f"OK: provider SDKs are lazy, startup within {budget_ms:.0f} ms budget")
+
+if __name__ == "__main__" and os.getenv("ENV") == "local":
+    _bench()
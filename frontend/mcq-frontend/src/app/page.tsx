@@ -4,7 +4,7 @@ import Image from "next/image";
 import React, { useState, useEffect } from "react";
 import { MCQConfig } from "../components/mcq-config";
 import { MCQTest } from "../components/mcq-test";
-import { generateQuestions, GenerateQuestionsRequest, Question } from "../lib/api";
+import { streamQuestions, getUserToken, GenerateQuestionsRequest, Question } from "../lib/api";
 import { FaGithub, FaLinkedin, FaTwitter } from "react-icons/fa";
 import { MdEmail } from "react-icons/md";
 import { Button } from "../components/ui/button";
@@ -42,12 +42,13 @@ export default function HomePage() {
         subject: params.subject as "java" | "python" | "sql" | "r" | "linux" | "analytics" | "cassandra" | "mongodb",
         difficulty: params.difficulty as "easy" | "medium" | "hard",
         num_questions: params.numQuestions,
+        user_token: getUserToken(),
       };
-      const response = await generateQuestions(data);
-      if (!response.questions || response.questions.length === 0) {
+      const received = await streamQuestions(data, (question) =>
+        setQuestions((prev) => [...prev, question])
+      );
+      if (received === 0) {
         setError("No questions returned from API.");
-      } else {
-        setQuestions(response.questions);
       }
     } catch (e: any) {
       setError(e?.message || "Failed to generate questions.");
@@ -142,7 +143,9 @@ export default function HomePage() {
           )}
         </>
       )}
-      {questions.length > 0 && <MCQTest questions={questions} onReset={handleReset} />}
+      {questions.length > 0 && (
+        <MCQTest questions={questions} onReset={handleReset} loading={loading} />
+      )}
     </main>
   );
 }
@@ -14,9 +14,10 @@ import { Question } from "../types/mcq";
 interface MCQTestProps {
   questions: Question[];
   onReset: () => void;
+  loading?: boolean; // more questions are still streaming in
 }
 
-export function MCQTest({ questions, onReset }: MCQTestProps) {
+export function MCQTest({ questions, onReset, loading = false }: MCQTestProps) {
   const [answers, setAnswers] = useState<Record<number, string>>({});
   const [submitted, setSubmitted] = useState(false);
 
@@ -121,8 +122,8 @@ export function MCQTest({ questions, onReset }: MCQTestProps) {
             </Card>
           ))}
           <div className="flex justify-center">
-            <Button onClick={handleSubmit} className="px-8 py-2 text-lg">
-              Submit Answers
+            <Button onClick={handleSubmit} disabled={loading} className="px-8 py-2 text-lg">
+              {loading ? "Generating more questions..." : "Submit Answers"}
             </Button>
           </div>
         </>
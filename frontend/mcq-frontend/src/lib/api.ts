@@ -1,13 +1,16 @@
 // src/lib/api.ts
 import axios from "axios";
 
+export type Subject = "java" | "python" | "sql" | "r" | "linux" | "analytics" | "cassandra" | "mongodb";
+
 export interface GenerateQuestionsRequest {
   api_key: string; // Gemini API key (required)
   fallback_api_key?: string; // optional OpenAI API key fallback
   fallback_model?: string; // optional fallback model, e.g. "gpt-3.5-turbo"
-  subject: "java" | "python" | "sql" | "r" | "linux" | "analytics" | "cassandra" | "mongodb";
+  subject: Subject;
   difficulty: "easy" | "medium" | "hard";
   num_questions: number;
+  user_token?: string; // questions already served to this token are skipped
 }
 
 export interface Question {
@@ -27,9 +30,119 @@ export interface GenerateQuestionsResponse {
 
 const API_BASE_URL =  process.env.NEXT_PUBLIC_API_BASE_URL || "http://localhost:8000";
 
+// Anonymous per-browser token so the backend can skip questions this user has already seen.
+export function getUserToken(): string {
+  const key = "mcq_user_token";
+  let token = localStorage.getItem(key);
+  if (!token) {
+    token = crypto.randomUUID();
+    localStorage.setItem(key, token);
+  }
+  return token;
+}
+
 export async function generateQuestions(
   data: GenerateQuestionsRequest
 ): Promise<GenerateQuestionsResponse> {
   const response = await axios.post(`${API_BASE_URL}/api/generate-questions`, data);
   return response.data;
 }
+
+export type StreamEvent =
+  | { type: "question"; question: Question }
+  | { type: "done"; subject: string; difficulty: string; num_questions: number; time_to_first_question_ms: number | null }
+  | { type: "error"; detail: string };
+
+// Streams questions as NDJSON, calling onQuestion as soon as each one is complete.
+export async function streamQuestions(
+  data: GenerateQuestionsRequest,
+  onQuestion: (question: Question) => void
+): Promise<number> {
+  const response = await fetch(`${API_BASE_URL}/api/generate-questions/stream`, {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify(data),
+  });
+  if (!response.ok || !response.body) {
+    throw new Error(`Request failed with status code ${response.status}`);
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  let received = 0;
+  for (;;) {
+    const { done, value } = await reader.read();
+    buffer += decoder.decode(value, { stream: !done });
+    const lines = buffer.split("\n");
+    buffer = done ? "" : lines.pop() ?? "";
+    for (const line of lines) {
+      if (!line.trim()) continue;
+      const event: StreamEvent = JSON.parse(line);
+      if (event.type === "question") {
+        received += 1;
+        onQuestion(event.question);
+      } else if (event.type === "error") {
+        throw new Error(event.detail);
+      }
+    }
+    if (done) return received;
+  }
+}
+
+export interface GeneratePaperRequest {
+  api_key: string;
+  fallback_api_key?: string;
+  fallback_model?: string;
+  subjects: Partial<Record<Subject, number>>; // e.g. { java: 10, sql: 10, linux: 5 }
+  difficulty: "easy" | "medium" | "hard";
+  user_token?: string;
+}
+
+export interface GeneratePaperResponse {
+  difficulty: string;
+  num_questions: number;
+  sections: GenerateQuestionsResponse[];
+  errors: Record<string, string>; // subjects that failed, with the reason
+}
+
+// Mock paper across several subjects, generated concurrently on the backend.
+export async function generatePaper(data: GeneratePaperRequest): Promise<GeneratePaperResponse> {
+  const response = await axios.post(`${API_BASE_URL}/api/generate-paper`, data);
+  return response.data;
+}
+
+export type PaperStreamEvent =
+  | { type: "question"; subject: Subject; question: Question }
+  | { type: "section_done"; subject: Subject; num_questions: number }
+  | { type: "error"; subject: Subject; detail: string }
+  | { type: "done"; difficulty: string; num_questions: number; subjects: Record<string, number>; time_to_first_question_ms: number | null };
+
+// Streams a mock paper as NDJSON. A failed subject is reported through onEvent and does not stop the others.
+export async function streamPaper(
+  data: GeneratePaperRequest,
+  onEvent: (event: PaperStreamEvent) => void
+): Promise<void> {
+  const response = await fetch(`${API_BASE_URL}/api/generate-paper/stream`, {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify(data),
+  });
+  if (!response.ok || !response.body) {
+    throw new Error(`Request failed with status code ${response.status}`);
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  for (;;) {
+    const { done, value } = await reader.read();
+    buffer += decoder.decode(value, { stream: !done });
+    const lines = buffer.split("\n");
+    buffer = done ? "" : lines.pop() ?? "";
+    for (const line of lines) {
+      if (line.trim()) onEvent(JSON.parse(line));
+    }
+    if (done) return;
+  }
+}